@@ -0,0 +1,192 @@
+"""
+Module for admission control of crawl jobs
+
+Load of the host is sampled in background. While cpu usage or available
+memory is over thresholds, number of concurrently running jobs is halved
+and it grows back by one per sample when the load is normal
+Jobs over the limit wait in the bounded queue, jobs that do not fit
+into the queue or wait too long are rejected with retry after hint
+"""
+
+import logging
+import threading
+import time
+
+from multiprocessing import cpu_count
+
+from host_info import HostInfo
+
+MAX_CPU = 85.0
+MIN_MEMORY = 512 * 1024 * 1024
+MAX_JOBS = 4
+MAX_QUEUE = 16
+MAX_WAIT = 30
+INTERVAL = 1.0
+RETRY_AFTER = 5
+EWMA_WEIGHT = 0.3
+WORKERS = cpu_count()
+
+
+class Admission(object):
+    """
+    Limits number of running jobs by load of the host
+    """
+
+    def __init__(self, max_cpu=MAX_CPU, min_memory=MIN_MEMORY,
+                 max_jobs=MAX_JOBS, max_queue=MAX_QUEUE, max_wait=MAX_WAIT,
+                 interval=INTERVAL, host_info=HostInfo):
+        """
+        :Parameters:
+            - `max_cpu`: float cpu usage percent considered as overload
+            - `min_memory`: int bytes of available memory considered
+              as overload
+            - `max_jobs`: int maximal number of running jobs
+            - `max_queue`: int maximal number of waiting jobs
+            - `max_wait`: float seconds job may wait in the queue
+            - `interval`: float seconds between samples of the load
+            - `host_info`: host_info.HostInfo
+        """
+        self.max_cpu = max_cpu
+        self.min_memory = min_memory
+        self.max_jobs = max_jobs
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.interval = interval
+        self.host_info = host_info
+        self.condition = threading.Condition()
+        self.limit = max_jobs
+        self.running = 0
+        self.waiting = 0
+        self.duration = None
+        self.load = {}
+        self.counters = dict.fromkeys(
+            ('admitted', 'queued', 'rejected', 'shrunk'), 0)
+        self.thread = None
+
+    def start(self):
+        """
+        Starts sampling of the load in background
+        """
+        def target():
+            while True:
+                try:
+                    self.sample()
+                except Exception:
+                    logging.exception('Failed to sample load of the host')
+                time.sleep(self.interval)
+
+        self.thread = threading.Thread(target=target)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def sample(self):
+        """
+        Reads load of the host and adjusts the limit of running jobs
+        :Return:
+            bool True if host is overloaded
+        """
+        load = {
+            'cpu': self.host_info.cpu_usage(),
+            'memory': self.host_info.ram_usage(),
+            'processes': self.host_info.processes_count(),
+        }
+        overloaded = (load['cpu'] >= self.max_cpu or
+                      load['memory'] <= self.min_memory)
+
+        with self.condition:
+            self.load = load
+            if overloaded and self.limit > 1:
+                self.limit //= 2
+                self.counters['shrunk'] += 1
+                logging.warning('Host is overloaded %s, running jobs are '
+                                'limited to %s', load, self.limit)
+            elif not overloaded and self.limit < self.max_jobs:
+                self.limit += 1
+                self.condition.notify_all()
+        return overloaded
+
+    def acquire(self):
+        """
+        Waits until the job may run
+        :Return:
+            bool False if the job is rejected
+        """
+        with self.condition:
+            if self.running < self.limit and not self.waiting:
+                return self._admit()
+            if self.waiting >= self.max_queue:
+                self.counters['rejected'] += 1
+                return False
+
+            self.counters['queued'] += 1
+            self.waiting += 1
+            deadline = time.time() + self.max_wait
+            try:
+                while self.running >= self.limit:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.counters['rejected'] += 1
+                        return False
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            return self._admit()
+
+    def _admit(self):
+        self.running += 1
+        self.counters['admitted'] += 1
+        return True
+
+    def release(self, duration):
+        """
+        :Parameters:
+            - `duration`: float seconds the job was running
+        """
+        with self.condition:
+            self.running -= 1
+            if self.duration is None:
+                self.duration = duration
+            else:
+                self.duration += EWMA_WEIGHT * (duration - self.duration)
+            self.condition.notify()
+
+    def run(self, func, *args, **kwargs):
+        """
+        Calls func holding the slot of running job
+        """
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.release(time.time() - start)
+
+    def retry_after(self):
+        """
+        :Return:
+            int seconds after which the rejected job may be sent again
+        """
+        with self.condition:
+            if self.duration is None:
+                return RETRY_AFTER
+            return max(1, int(round(
+                self.duration * (self.waiting + 1) / max(self.limit, 1))))
+
+    def workers(self):
+        """
+        :Return:
+            int number of parsing processes for the job,
+            shrinks with the limit of running jobs
+        """
+        return max(1, WORKERS * self.limit // self.max_jobs)
+
+    def stats(self):
+        """
+        :Return:
+            dict with load of the host, limits and decisions
+        """
+        with self.condition:
+            stats = dict(self.counters, limit=self.limit,
+                         running=self.running, waiting=self.waiting,
+                         load=self.load)
+        stats['parse_workers'] = self.workers()
+        return stats
@@ -0,0 +1,233 @@
+"""
+Module for recording fetched pages and replaying them offline
+
+Archive is append-only file of gzip members, one member per response
+The member holds json line with url, status and headers followed by
+the body. Offsets of members are kept in the index file next to the
+archive, so any page is read by url with one seek. The index is rebuilt
+from the archive when it is missing or behind the archive
+"""
+
+import gzip
+import json
+import logging
+import os
+import threading
+import zlib
+
+from collections import OrderedDict
+from StringIO import StringIO
+
+from http_cache import CachedResponse
+from parsing import list_of_links_from_contents
+
+INDEX_SUFFIX = '.idx'
+READ_SIZE = 65536
+
+
+def _encode(record, content):
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(json.dumps(record) + '\n')
+        f.write(content)
+    return buf.getvalue()
+
+
+def _decode(data):
+    header, content = data.split('\n', 1)
+    record = json.loads(header)
+    return record, content
+
+
+class PageArchive(object):
+    """
+    Compressed append-only archive of responses indexed by url
+    """
+
+    def __init__(self, path):
+        """
+        :Parameters:
+            - `path`: str path to the archive file
+        """
+        self.path = path
+        self.index_path = path + INDEX_SUFFIX
+        self.lock = threading.Lock()
+        self.index = OrderedDict()
+        self.size = 0
+
+        self.writer = open(path, 'ab')
+        self._load_index()
+        self.indexer = open(self.index_path, 'ab')
+
+    def _load_index(self):
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                for line in f:
+                    try:
+                        url, offset, length = json.loads(line)
+                    except ValueError:
+                        break
+                    self.index.pop(url, None)
+                    self.index[url] = (offset, length)
+                    self.size = max(self.size, offset + length)
+
+        if os.path.getsize(self.path) != self.size:
+            logging.warning('Index of archive %s is behind, rebuilding',
+                            self.path)
+            self._rebuild_index()
+
+    def _members(self):
+        """
+        Reads the archive sequentially, stops at truncated record
+        :Return:
+            generator of tuple(offset, length, decompressed record)
+        """
+        with open(self.path, 'rb') as f:
+            offset = 0
+            data = f.read(READ_SIZE)
+            while data:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                chunks = []
+                length = 0
+                try:
+                    while data and not decompressor.unused_data:
+                        chunks.append(decompressor.decompress(data))
+                        length += len(data)
+                        data = decompressor.unused_data or f.read(READ_SIZE)
+                    length -= len(decompressor.unused_data)
+                    if not data:
+                        # the last record has no data after it
+                        # to prove it is complete
+                        f.seek(offset)
+                        zlib.decompress(f.read(length), 16 + zlib.MAX_WBITS)
+                except zlib.error:
+                    logging.warning('Truncated record at %s of archive %s',
+                                    offset, self.path)
+                    return
+                yield offset, length, ''.join(chunks)
+                offset += length
+
+    def _rebuild_index(self):
+        self.index.clear()
+        self.size = 0
+        with open(self.index_path, 'wb') as index:
+            for offset, length, data in self._members():
+                record, _ = _decode(data)
+                self.index.pop(record['url'], None)
+                self.index[record['url']] = (offset, length)
+                index.write(json.dumps([record['url'], offset, length]) + '\n')
+                self.size = offset + length
+
+        if os.path.getsize(self.path) > self.size:
+            with open(self.path, 'r+b') as f:
+                f.truncate(self.size)
+
+    def record(self, url, response):
+        """
+        Appends the response to the archive
+        :Parameters:
+            - `url`: str
+            - `response`: object with status_code, headers and content
+        """
+        data = _encode({'url': url, 'status': response.status_code,
+                        'headers': dict(response.headers or {})},
+                       response.content)
+        with self.lock:
+            offset = self.size
+            self.writer.write(data)
+            self.writer.flush()
+            self.indexer.write(json.dumps([url, offset, len(data)]) + '\n')
+            self.indexer.flush()
+            self.size += len(data)
+            self.index.pop(url, None)
+            self.index[url] = (offset, len(data))
+
+    def wrap(self, request):
+        """
+        :Parameters:
+            - `request`: callable that takes url
+        :Return:
+            callable that takes url and records the response
+        """
+        def inner(url, *args, **kwargs):
+            response = request(url, *args, **kwargs)
+            if response is not None:
+                self.record(url, response)
+            return response
+
+        return inner
+
+    def get(self, url):
+        """
+        :Parameters:
+            - `url`: str
+        :Return:
+            http_cache.CachedResponse or None if url is not archived
+        """
+        position = self.index.get(url)
+        if position is None:
+            return None
+
+        offset, length = position
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            data = zlib.decompress(f.read(length), 16 + zlib.MAX_WBITS)
+        record, content = _decode(data)
+        return CachedResponse(record['status'], content, record['headers'])
+
+    def urls(self):
+        """
+        :Return:
+            list of archived urls in order of the archive
+        """
+        return sorted(self.index, key=self.index.get)
+
+    def pages(self, urls=None):
+        """
+        Replays archived pages, reads whole archive sequentially
+        when urls are not given
+        :Parameters:
+            - `urls`: iterable of str, urls missing in archive are skipped
+        :Return:
+            generator of tuple(url, str page body)
+        """
+        if urls is not None:
+            for url in urls:
+                response = self.get(url)
+                if response is not None:
+                    yield url, response.content
+            return
+
+        self.writer.flush()
+        for offset, _, data in self._members():
+            record, content = _decode(data)
+            if self.index.get(record['url'], (None,))[0] == offset:
+                yield record['url'], content
+
+    def __contains__(self, url):
+        return url in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        self.writer.close()
+        self.indexer.close()
+
+
+def replay(archive, urls=None, parser=''):
+    """
+    Feeds archived pages into parsing.list_of_links_from_contents
+    :Parameters:
+        - `archive`: PageArchive
+        - `urls`: list of str, all archived urls by default
+        - `parser`: str name of the parser to use
+    :Return:
+        generator of tuple(url, href)
+    """
+    urls = archive.urls() if urls is None else [url for url in urls
+                                                if url in archive]
+    contents = (content for _, content in archive.pages(urls))
+    return list_of_links_from_contents(contents, urls, parser)
@@ -0,0 +1,406 @@
+"""
+Offline benchmark of the insert_db.fetch_urls pipeline
+
+Runs the real pipeline against local stand-ins:
+synthetic http server, fake dns resolver and in-memory db api
+Pages recorded by archive.PageArchive can be replayed instead of
+the synthetic ones
+Results are saved as json so runs can be compared between commits
+"""
+
+import argparse
+import json
+import logging
+import resource
+import subprocess
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from collections import defaultdict
+
+import db_api
+import insert_db
+import parse_pool
+import parsing
+from archive import PageArchive
+from local import settings
+from patch import patch
+from records import LinkBatch
+from scheduler import HostScheduler
+from utils import percentile
+
+PAGE_PATH = '/page/%s'
+
+
+class Timings(object):
+    """
+    Collects durations of the pipeline stages
+    """
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def add(self, stage, duration):
+        """
+        :Parameters:
+            - `stage`: str name of the stage
+            - `duration`: float seconds
+        """
+        with self.lock:
+            self.samples[stage].append(duration)
+
+    def timed(self, stage, func):
+        """
+        :Parameters:
+            - `stage`: str name of the stage
+            - `func`: callable to measure
+        :Return:
+            wrapped function
+        """
+
+        def inner(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.time() - start)
+
+        return inner
+
+    def report(self):
+        """
+        :Return:
+            dict[stage, dict] with count, p50 and p99 in milliseconds
+        """
+        result = {}
+        for stage, values in self.samples.items():
+            result[stage] = {
+                'count': len(values),
+                'total_ms': sum(values) * 1000,
+                'p50_ms': percentile(values, 50) * 1000,
+                'p99_ms': percentile(values, 99) * 1000,
+            }
+        return result
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def page_handler(links, size, latency, hosts):
+    """
+    Creates handler class that serves synthetic pages
+    :Parameters:
+        - `links`: int number of links on every page
+        - `size`: int minimal size of the page in bytes
+        - `latency`: float seconds to wait before answering
+        - `hosts`: int number of distinct hosts used in links
+    :Return:
+        BaseHTTPRequestHandler subclass
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            time.sleep(latency)
+            anchors = ['<a href="http://host%s.bench.local/%s">l</a>' %
+                       (i % hosts, i) for i in range(links)]
+            body = '<html><body>%s</body></html>' % ''.join(anchors)
+            body += ' ' * max(size - len(body), 0)
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def start_http_server(links, size, latency, hosts):
+    """
+    Runs synthetic http server in the background thread
+    :Return:
+        ThreadingHTTPServer
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                 page_handler(links, size, latency, hosts))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def fake_resolver(latency):
+    """
+    :Parameters:
+        - `latency`: float seconds spent on every lookup
+    :Return:
+        function that replaces socket.gethostbyname
+    """
+
+    def gethostbyname(domain):
+        time.sleep(latency)
+        if not domain:
+            raise parsing.socket.error()
+        return '10.0.%s.%s' % (hash(domain) % 256, len(domain) % 256)
+
+    return gethostbyname
+
+
+class FakeDBAPI(object):
+    """
+    In-memory stand-in for db_api.DBAPI
+    """
+
+    rows = None
+
+    def __init__(self, latency=0, **settings):
+        self.latency = latency
+        self.urls = {}
+        self.rows = defaultdict(int)
+        FakeDBAPI.rows = self.rows
+
+    def insert_urls(self, urls):
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
+        for url in urls:
+            self.urls[url] = len(self.urls) + 1
+        return timestamp
+
+    def get_url_ids(self, urls, timestamp):
+        return dict((url, self.urls[url]) for url in urls)
+
+    def insert(self, data):
+        time.sleep(self.latency)
+        for domain, ip, url_id, counter in data:
+            self.rows[(domain, ip, url_id)] += counter
+
+    def close(self):
+        pass
+
+
+def run(pages=50, links=100, size=20000, page_latency=0.0, hosts=20,
+        dns_latency=0.0, db_latency=0.0, parse_workers=1, concurrency=0,
+        archive=''):
+    """
+    Runs insert_db.fetch_urls against local stand-ins
+    :Parameters:
+        - `pages`: int number of seed pages
+        - `links`: int number of links on every page
+        - `size`: int size of every page in bytes
+        - `page_latency`: float seconds of http latency
+        - `hosts`: int number of distinct hosts in links
+        - `dns_latency`: float seconds of dns latency
+        - `db_latency`: float seconds spent on every db insert
+        - `parse_workers`: int number of parsing processes, parse stage
+          is measured only for in-process parsing
+        - `concurrency`: int number of concurrent requests, 0 to fetch
+          pages one by one
+        - `archive`: str path to the page archive to replay first pages
+          of instead of fetching synthetic pages
+    :Return:
+        dict with results
+    """
+    timings = Timings()
+    server = start_http_server(links, size, page_latency, hosts)
+    base = 'http://127.0.0.1:%s' % server.server_address[1]
+    urls = [base + PAGE_PATH % i for i in range(pages)]
+    replay = archive and PageArchive(archive)
+    if replay:
+        urls = replay.urls()[:pages]
+
+    # every page is served by one local host, so politeness limits are lifted
+    scheduler = concurrency and HostScheduler(
+        concurrency=concurrency, host_rate=1000, host_burst=concurrency,
+        host_limit=concurrency, max_host_limit=concurrency)
+
+    def db_factory(**settings):
+        db = FakeDBAPI(latency=db_latency)
+        db.insert = timings.timed('db', db.insert)
+        return db
+
+    def parser_factory(name):
+        return timings.timed('parse', original_parser_factory(name))
+
+    original_parser_factory = parse_pool.parser_factory
+
+    try:
+        with patch('parsing.socket.gethostbyname',
+                   timings.timed('resolve', fake_resolver(dns_latency))), \
+                patch('parsing.request_page',
+                      timings.timed('fetch', parsing.request_page)), \
+                patch('parse_pool.parser_factory', parser_factory), \
+                patch('insert_db.db_api.DBAPI', db_factory):
+            start = time.time()
+            insert_db.fetch_urls(urls, parse_workers=parse_workers,
+                                 scheduler=scheduler or None,
+                                 replay=replay or None)
+            elapsed = time.time() - start
+    finally:
+        server.shutdown()
+        server.server_close()
+        if replay:
+            replay.close()
+
+    stored_links = sum((FakeDBAPI.rows or {}).values())
+
+    return {
+        'commit': current_commit(),
+        'params': dict(pages=pages, links=links, size=size,
+                       page_latency=page_latency, hosts=hosts,
+                       dns_latency=dns_latency, db_latency=db_latency,
+                       parse_workers=parse_workers, concurrency=concurrency,
+                       archive=archive),
+        'elapsed': elapsed,
+        'pages_per_sec': len(urls) / elapsed,
+        'links_per_sec': stored_links / elapsed,
+        'links': stored_links,
+        'stages': timings.report(),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'scheduler': scheduler and scheduler.stats(),
+    }
+
+
+def run_ingest(sizes):
+    """
+    Compares multi-row inserts with LOAD DATA bulk path on the real db
+    :Parameters:
+        - `sizes`: list of int numbers of rows
+    :Return:
+        dict with seconds per path and the smallest size
+        where bulk path is faster
+    """
+    db = db_api.DBAPI(**settings)
+    results = []
+    for size in sizes:
+        result = {'rows': size}
+        for path in ('insert', 'bulk'):
+            url = 'bench-%s-%s-%s' % (path, size, time.time())
+            url_id = insert_db.insert_urls(db, [url])[url]
+            rows = [('host%s.bench.local' % i, i, url_id, 1)
+                    for i in range(size)]
+            # the same packed rows fetch_urls writes
+            batch = LinkBatch()
+            for row in rows:
+                batch.add(*row)
+
+            start = time.time()
+            if path == 'bulk':
+                db.bulk_insert(rows)
+            else:
+                db.bulk_threshold = None
+                db.insert(batch)
+            result[path] = time.time() - start
+        results.append(result)
+
+    faster = [item['rows'] for item in results
+              if item['bulk'] < item['insert']]
+    return {
+        'commit': current_commit(),
+        'ingest': results,
+        'crossover_rows': faster and min(faster) or None,
+    }
+
+
+def current_commit():
+    """
+    :Return:
+        str hash of the current git commit or None
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    """
+    Compares two benchmark results
+    :Parameters:
+        - `old`: dict previous result
+        - `new`: dict current result
+    :Return:
+        dict[metric, float] ratio new / old
+    """
+    ratios = {}
+    for key in ('pages_per_sec', 'links_per_sec', 'peak_rss_kb'):
+        if old.get(key):
+            ratios[key] = float(new[key]) / old[key]
+    for stage, stats in new['stages'].items():
+        previous = old.get('stages', {}).get(stage)
+        if previous and previous['p99_ms']:
+            ratios['%s_p99' % stage] = stats['p99_ms'] / previous['p99_ms']
+    return ratios
+
+
+def create_parser(description=''):
+    """
+    :Parameters:
+        - `description`: str name of the parser
+    :Return:
+        argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('--pages', type=int, default=50)
+    parser.add_argument('--links', type=int, default=100)
+    parser.add_argument('--size', type=int, default=20000)
+    parser.add_argument('--hosts', type=int, default=20)
+    parser.add_argument('--page-latency', type=float, default=0.0,
+                        dest='page_latency')
+    parser.add_argument('--dns-latency', type=float, default=0.0,
+                        dest='dns_latency')
+    parser.add_argument('--db-latency', type=float, default=0.0,
+                        dest='db_latency')
+    parser.add_argument('--parse-workers', type=int, default=1,
+                        dest='parse_workers')
+    parser.add_argument('--concurrency', type=int, default=0)
+    parser.add_argument('--archive', default='',
+                        help='Path to page archive to replay')
+    parser.add_argument('--ingest', help='Comma separated numbers of rows '
+                        'to compare db insert paths, needs the real db')
+    parser.add_argument('--output', help='Path to save json results',
+                        default='benchmark.json')
+    parser.add_argument('--compare', help='Path to previous json results')
+
+    return parser
+
+
+def main():
+    """
+    The main function of the benchmark
+    """
+    args = create_parser('Offline pipeline benchmark.').parse_args()
+    logging.disable(logging.CRITICAL)
+
+    if args.ingest:
+        result = run_ingest([int(size) for size in args.ingest.split(',')])
+    else:
+        result = run(pages=args.pages, links=args.links, size=args.size,
+                     page_latency=args.page_latency, hosts=args.hosts,
+                     dns_latency=args.dns_latency,
+                     db_latency=args.db_latency,
+                     parse_workers=args.parse_workers,
+                     concurrency=args.concurrency,
+                     archive=args.archive)
+
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+    if args.compare and not args.ingest:
+        with open(args.compare) as f:
+            print(json.dumps(compare(json.load(f), result), indent=2,
+                             sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+"""
+Module for running the crawl in several worker processes
+
+Seed urls are partitioned by consistent hash of their domain,
+so every domain is always crawled by the same worker
+Workers send results to the single aggregator through the local socket
+as newline delimited json, the aggregator queues them to writer.DBWriter
+that owns the db connection, so batches of all workers that arrive
+during a commit are written with the next one
+"""
+
+import argparse
+import bisect
+import hashlib
+import json
+import logging
+import select
+import socket
+
+from multiprocessing import Process, cpu_count
+
+import requests
+
+import db_api
+from insert_db import BATCH_SIZE, insert_urls
+from local import settings
+from parsing import Resolver, data_from_urls, domain_from_url
+from records import LinkBatch, ip_to_int
+from utils import split_every
+from writer import DBWriter
+
+WORKERS = cpu_count()
+REPLICAS = 100
+POLL_TIMEOUT = 1
+
+
+class HashRing(object):
+    """
+    Consistent hash ring with virtual nodes
+    """
+
+    def __init__(self, nodes, replicas=REPLICAS):
+        """
+        :Parameters:
+            - `nodes`: list of node names
+            - `replicas`: int number of virtual nodes per node
+        """
+        self.ring = sorted((self._hash('%s:%s' % (node, i)), node)
+                           for node in nodes for i in range(replicas))
+        self.keys = [key for key, _ in self.ring]
+
+    @staticmethod
+    def _hash(key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def node(self, key):
+        """
+        :Parameters:
+            - `key`: str
+        :Return:
+            node that owns the key
+        """
+        index = bisect.bisect(self.keys, self._hash(key)) % len(self.keys)
+        return self.ring[index][1]
+
+
+def partition(urls, workers):
+    """
+    :Parameters:
+        - `urls`: iterable of str
+        - `workers`: int number of shards
+    :Return:
+        list of list of str, one list of urls per worker
+    """
+    ring = HashRing(range(workers))
+    shards = [[] for _ in range(workers)]
+    for url in urls:
+        shards[ring.node(domain_from_url(url))].append(url)
+    return shards
+
+
+def send(connection, message):
+    """
+    :Parameters:
+        - `connection`: socket.socket
+        - `message`: dict
+    """
+    connection.sendall(json.dumps(message) + '\n')
+
+
+def worker(number, urls, address, parse_workers=1):
+    """
+    Crawls shard of urls and sends results to the aggregator
+    :Parameters:
+        - `number`: int number of the worker
+        - `urls`: list of str
+        - `address`: tuple(host, port) of the aggregator
+        - `parse_workers`: int number of parsing processes
+    """
+    connection = socket.create_connection(address)
+    # hosts of the shard are fetched only by this worker, so its
+    # connections and resolved ips are reused across pages
+    session, resolver = requests.Session(), Resolver()
+    links = 0
+    try:
+        data = data_from_urls(urls, parse_workers, session=session,
+                              resolver=resolver)
+        for lst in split_every(BATCH_SIZE, data):
+            rows = [(url, info.domain, ip_to_int(info.ip))
+                    for url, info in lst]
+            send(connection, {'type': 'links', 'worker': number,
+                              'rows': rows})
+            links += len(rows)
+        send(connection, {'type': 'done', 'worker': number, 'links': links})
+    finally:
+        session.close()
+        connection.close()
+
+
+class Aggregator(object):
+    """
+    Receives results from workers and writes them into db
+    """
+
+    def __init__(self, writer, url_ids, host='127.0.0.1', port=0):
+        """
+        :Parameters:
+            - `writer`: writer.DBWriter, closed by the caller
+            - `url_ids`: dict[url, url_id]
+            - `host`: str
+            - `port`: int, 0 to pick free port
+        """
+        self.writer = writer
+        self.url_ids = url_ids
+        self.server = socket.socket()
+        self.server.bind((host, port))
+        self.server.listen(5)
+        self.address = self.server.getsockname()
+        self.stats = {'links': 0, 'batches': 0, 'done': 0, 'failed': 0}
+
+    def handle(self, message):
+        """
+        :Parameters:
+            - `message`: dict received from the worker
+        """
+        if message['type'] == 'links':
+            batch = LinkBatch()
+            for url, domain, ip in message['rows']:
+                batch.add(domain, ip, self.url_ids[url])
+            # failed commits are logged and counted by the writer,
+            # which reconnects with the next group
+            self.writer.put(batch)
+            self.stats['links'] += len(message['rows'])
+            self.stats['batches'] += 1
+        elif message['type'] == 'done':
+            self.stats['done'] += 1
+
+    def serve(self, processes):
+        """
+        Reads results until every worker finished
+        :Parameters:
+            - `processes`: list of multiprocessing.Process
+        :Return:
+            dict stats
+        """
+        buffers = {}
+        finished = 0
+
+        while finished < len(processes):
+            readable, _, _ = select.select([self.server] + buffers.keys(),
+                                           [], [], POLL_TIMEOUT)
+            if not readable and not buffers and \
+                    not any(p.is_alive() for p in processes):
+                logging.error('Workers exited without connecting')
+                self.stats['failed'] += len(processes) - finished
+                break
+
+            for connection in readable:
+                if connection is self.server:
+                    client, address = self.server.accept()
+                    buffers[client] = ''
+                    continue
+
+                data = connection.recv(65536)
+                if not data:
+                    if buffers.pop(connection):
+                        logging.error('Incomplete message from worker')
+                    connection.close()
+                    finished += 1
+                    continue
+
+                lines = (buffers[connection] + data).split('\n')
+                buffers[connection] = lines.pop()
+                for line in lines:
+                    self.handle(json.loads(line))
+
+        self.stats['failed'] += finished - self.stats['done']
+        return self.stats
+
+    def close(self):
+        self.server.close()
+
+
+def fetch_urls(urls, workers=WORKERS, parse_workers=1):
+    """
+    Fetches urls in several processes and inserts them into db
+    :Parameters:
+        - `urls`: list of str
+        - `workers`: int number of crawling processes
+        - `parse_workers`: int number of parsing processes per worker
+    :Return:
+        dict stats with stats of the writer, lost_batches is the number
+        of groups that were not written, or None if urls were not inserted
+    """
+    urls = set(urls)
+    db = db_api.DBAPI(**settings)
+    try:
+        url_ids = insert_urls(db, urls)
+        if url_ids is None:
+            return
+
+        aggregator = Aggregator(DBWriter(db), url_ids)
+        processes = [Process(target=worker,
+                             args=(number, shard, aggregator.address,
+                                   parse_workers))
+                     for number, shard in enumerate(partition(urls, workers))
+                     if shard]
+        for process in processes:
+            process.start()
+        # started after the fork, so workers do not inherit its thread
+        aggregator.writer.start()
+
+        try:
+            stats = aggregator.serve(processes)
+        finally:
+            for process in processes:
+                process.join()
+            aggregator.close()
+            writer_stats = aggregator.writer.close()
+        stats['writer'] = writer_stats
+        stats['lost_batches'] = writer_stats['failed']
+        return stats
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sharded crawl.')
+    parser.add_argument('urls', nargs='+')
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--parse-workers', type=int, default=1,
+                        dest='parse_workers')
+    args = parser.parse_args()
+
+    print(fetch_urls(args.urls, args.workers, args.parse_workers))
+
+
+if __name__ == '__main__':
+    main()
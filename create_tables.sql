@@ -1,5 +1,8 @@
 USE host;
 
+DROP TABLE IF EXISTS `domain_hour`;
+DROP TABLE IF EXISTS `url_totals`;
+DROP TABLE IF EXISTS `spool_batches`;
 DROP TABLE IF EXISTS `urls`;
 DROP TABLE IF EXISTS `domain_ip`;
 
@@ -24,6 +27,29 @@ CREATE TABLE domain_ip (
     ON UPDATE CASCADE
 );
 
+CREATE TABLE domain_hour (
+  domain  VARCHAR(100) NOT NULL,
+  hour    DATETIME     NOT NULL,
+  counter BIGINT       DEFAULT 0,
+  PRIMARY KEY (`hour`, `domain`)
+);
+
+CREATE TABLE url_totals (
+  url_id  INT    NOT NULL,
+  counter BIGINT DEFAULT 0,
+  PRIMARY KEY (`url_id`),
+  CONSTRAINT FOREIGN KEY `url_totals_fk` (`url_id`) REFERENCES `urls`
+  (`id`)
+    ON DELETE CASCADE
+    ON UPDATE CASCADE
+);
+
+CREATE TABLE spool_batches (
+  id      CHAR(32)  NOT NULL,
+  applied TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`)
+);
+
 INSERT INTO domain_ip (domain, ip, url_id, counter)
 VALUES (%s, INET_ATON( % s), %s, %s)
 ON DUPLICATE KEY UPDATE counter = counter + VALUES (counter);
@@ -3,12 +3,22 @@ Module that provides basic API for inserting/updating info in db
 """
 
 import logging
+import tempfile
 import time
 import datetime
 
-from pymysql import OperationalError, InternalError
+from collections import Counter
+
+from pymysql import (InterfaceError, InternalError, MySQLError,
+                     OperationalError)
+from pymysql.cursors import SSCursor
 
 from connector import get_connection
+from records import LinkBatch, ip_to_int
+
+BULK_THRESHOLD = 5000
+HOUR_FORMAT = '%Y-%m-%d %H:00:00'
+CONNECTION_ERRORS = (OperationalError, InterfaceError)
 
 
 class DBAPIException(Exception):
@@ -29,6 +39,11 @@ class DBAPI(object):
     ON DUPLICATE KEY UPDATE counter = counter + VALUES (counter);
     """
 
+    INSERT_PACKED_LINK = """INSERT INTO domain_ip (domain, ip, url_id, counter)
+    VALUES (%s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE counter = counter + VALUES (counter);
+    """
+
     FETCH_URL_IDS = """SELECT
       id,
       url
@@ -37,11 +52,129 @@ class DBAPI(object):
 
     REMOVE_OLD_URLS = """DELETE FROM urls WHERE creation_time > %s;"""
 
-    def __init__(self, user, password, host, database):
+    EXPORT_DOMAIN_IPS = """SELECT
+      urls.id,
+      urls.url,
+      urls.creation_time,
+      domain_ip.domain,
+      INET_NTOA(domain_ip.ip),
+      domain_ip.counter
+    FROM urls
+      JOIN domain_ip ON domain_ip.url_id = urls.id"""
+
+    CREATE_STAGE = """CREATE TEMPORARY TABLE IF NOT EXISTS domain_ip_stage (
+      domain  VARCHAR(100),
+      ip      INT UNSIGNED,
+      url_id  INT,
+      counter INT UNSIGNED
+    );"""
+
+    LOAD_STAGE = """LOAD DATA LOCAL INFILE %s INTO TABLE domain_ip_stage
+    (domain, ip, url_id, counter);"""
+
+    MERGE_STAGE = """INSERT INTO domain_ip (domain, ip, url_id, counter)
+    SELECT * FROM (
+      SELECT domain, ip, url_id, SUM(counter) AS total
+      FROM domain_ip_stage
+      GROUP BY domain, ip, url_id
+    ) AS stage
+    ON DUPLICATE KEY UPDATE counter = domain_ip.counter + stage.total;"""
+
+    TRUNCATE_STAGE = """TRUNCATE TABLE domain_ip_stage;"""
+
+    DROP_STAGE = """DROP TEMPORARY TABLE IF EXISTS domain_ip_stage;"""
+
+    UPSERT_DOMAIN_HOUR = """INSERT INTO domain_hour (domain, hour, counter)
+    VALUES (%s, %s, %s)
+    ON DUPLICATE KEY UPDATE counter = counter + VALUES (counter);"""
+
+    UPSERT_URL_TOTAL = """INSERT INTO url_totals (url_id, counter)
+    VALUES (%s, %s)
+    ON DUPLICATE KEY UPDATE counter = counter + VALUES (counter);"""
+
+    MERGE_STAGE_DOMAIN_HOUR = """INSERT INTO domain_hour
+    (domain, hour, counter)
+    SELECT * FROM (
+      SELECT
+        domain_ip_stage.domain,
+        DATE_FORMAT(urls.creation_time, '%Y-%m-%d %H:00:00') AS hour,
+        SUM(domain_ip_stage.counter) AS total
+      FROM domain_ip_stage
+        JOIN urls ON domain_ip_stage.url_id = urls.id
+      GROUP BY 1, 2
+    ) AS stage
+    ON DUPLICATE KEY UPDATE counter = domain_hour.counter + stage.total;"""
+
+    MERGE_STAGE_URL_TOTAL = """INSERT INTO url_totals (url_id, counter)
+    SELECT * FROM (
+      SELECT url_id, SUM(counter) AS total
+      FROM domain_ip_stage
+      GROUP BY url_id
+    ) AS stage
+    ON DUPLICATE KEY UPDATE counter = url_totals.counter + stage.total;"""
+
+    REBUILD_DOMAIN_HOUR = """INSERT INTO domain_hour (domain, hour, counter)
+    SELECT
+      domain_ip.domain,
+      DATE_FORMAT(urls.creation_time, '%Y-%m-%d %H:00:00'),
+      SUM(domain_ip.counter)
+    FROM domain_ip
+      JOIN urls ON domain_ip.url_id = urls.id
+    GROUP BY 1, 2;"""
+
+    REBUILD_URL_TOTAL = """INSERT INTO url_totals (url_id, counter)
+    SELECT url_id, SUM(counter) FROM domain_ip GROUP BY url_id;"""
+
+    TOP_DOMAINS = """SELECT
+      domain,
+      SUM(counter) AS total
+    FROM domain_hour
+    WHERE hour >= %s
+    GROUP BY domain
+    ORDER BY total DESC
+    LIMIT %s;"""
+
+    FETCH_URL_HOURS = """SELECT
+      id,
+      DATE_FORMAT(creation_time, %s)
+    FROM urls
+    WHERE id IN %s;"""
+
+    FETCH_URL_TOTALS = """SELECT
+      url_id,
+      counter
+    FROM url_totals
+    WHERE url_id IN %s;"""
+
+    SET_PACKED_LINK = """INSERT INTO domain_ip (domain, ip, url_id, counter)
+    VALUES (%s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE counter = VALUES (counter);
+    """
+
+    DELETE_LINK = """DELETE FROM domain_ip
+    WHERE domain = %s AND ip = %s AND url_id = %s;"""
+
+    FETCH_URL_LINKS = """SELECT
+      url_id,
+      domain,
+      ip,
+      counter
+    FROM domain_ip
+    WHERE url_id IN %s;"""
+
+    FETCH_EXISTING_URL_IDS = """SELECT id FROM urls WHERE id IN %s;"""
+
+    FETCH_SPOOLED = """SELECT id FROM spool_batches WHERE id IN %s;"""
+
+    INSERT_SPOOLED = """INSERT INTO spool_batches (id) VALUES (%s);"""
+
+    def __init__(self, user, password, host, database,
+                 bulk_threshold=BULK_THRESHOLD):
         self.user = user
         self.password = password
         self.host = host
         self.db = database
+        self.bulk_threshold = bulk_threshold
 
     @property
     def connection(self):
@@ -51,7 +184,8 @@ class DBAPI(object):
                     user=self.user,
                     password=self.password,
                     host=self.host,
-                    database=self.db
+                    database=self.db,
+                    local_infile=True
                 ))
             except OperationalError as err:
                 raise DBAPIException(err)
@@ -75,15 +209,261 @@ class DBAPI(object):
         """
         :Parameters:
             - `data`: list of tuple(domain, ip, url_id, counter)
+              or records.LinkBatch with packed ips
+        Switches to bulk_insert when there are at least bulk_threshold rows
         """
+        query = self.INSERT_LINK
+        if isinstance(data, LinkBatch):
+            query, data = self.INSERT_PACKED_LINK, list(data)
+
+        if self.bulk_threshold and len(data) >= self.bulk_threshold:
+            return self.bulk_insert(data)
 
         try:
             with self.connection.cursor() as cursor:
-                cursor.executemany(self.INSERT_LINK, data)
+                cursor.executemany(query, data)
+                self.update_rollups(cursor, data)
                 self.connection.commit()
 
-        except InternalError as err:
+        except MySQLError as err:
             logging.exception('Wrong query when inserting %s', data)
+            self.rollback(err)
+            raise
+
+    def bulk_insert(self, data):
+        """
+        Loads rows into the staging table with LOAD DATA LOCAL INFILE and
+        merges them into domain_ip with single query
+        :Parameters:
+            - `data`: iterable of tuple(domain, ip, url_id, counter),
+              ip is either packed int or dotted-quad str
+        """
+        with infile(data) as f:
+            try:
+                with self.connection.cursor() as cursor:
+                    self.load_infile(cursor, f.name)
+                    self.connection.commit()
+
+            except MySQLError as err:
+                logging.exception('Wrong query when loading %s', f.name)
+                self.rollback(err, self.DROP_STAGE)
+                raise
+
+    def rollback(self, error, *cleanup):
+        """
+        Rolls back the transaction failed with error, so its rows are not
+        committed by the next one. Connection that failed or was lost is
+        dropped instead, so the next query reconnects. Errors of the
+        rollback are only logged, the original error is raised by the
+        caller
+        :Parameters:
+            - `error`: pymysql.MySQLError
+            - `cleanup`: str queries executed after the rollback
+        """
+        connection = getattr(self, '_connection', None)
+        if connection is None:
+            return
+        if isinstance(error, CONNECTION_ERRORS):
+            self.reset()
+            return
+        try:
+            connection.rollback()
+            with connection.cursor() as cursor:
+                for query in cleanup:
+                    cursor.execute(query)
+        except MySQLError:
+            logging.exception('Failed to roll back')
+            self.reset()
+
+    def close(self):
+        """
+        Closes the connection
+        """
+        self.reset()
+
+    def reset(self):
+        """
+        Closes and drops the connection, the next query reconnects
+        """
+        connection = self.__dict__.pop('_connection', None)
+        if connection is None:
+            return
+        try:
+            connection.close()
+        except (MySQLError, EnvironmentError):
+            pass
+
+    def load_infile(self, cursor, path):
+        """
+        Merges rows of the file into domain_ip and rollups,
+        must be committed by the caller
+        :Parameters:
+            - `cursor`: pymysql.cursor
+            - `path`: str path to the file written by infile
+        """
+        cursor.execute(self.CREATE_STAGE)
+        cursor.execute(self.TRUNCATE_STAGE)
+        cursor.execute(self.LOAD_STAGE, (path,))
+        cursor.execute(self.MERGE_STAGE)
+        cursor.execute(self.MERGE_STAGE_DOMAIN_HOUR)
+        cursor.execute(self.MERGE_STAGE_URL_TOTAL)
+
+    def insert_spooled(self, records):
+        """
+        Loads spooled batches that were not applied yet, ids of batches
+        are stored in the same transaction, so replay is idempotent
+        :Parameters:
+            - `records`: list of tuple(batch_id, rows) from spool
+        :Return:
+            int number of applied batches
+        """
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute(self.FETCH_SPOOLED,
+                               ([batch_id for batch_id, _ in records],))
+                applied = set(batch_id for batch_id, in cursor.fetchall())
+
+                new = [(batch_id, rows) for batch_id, rows in records
+                       if batch_id not in applied]
+                if new:
+                    with infile(row for _, rows in new
+                                for row in rows) as f:
+                        self.load_infile(cursor, f.name)
+                    cursor.executemany(self.INSERT_SPOOLED,
+                                       [(batch_id,) for batch_id, _ in new])
+                self.connection.commit()
+
+        except MySQLError as err:
+            logging.exception('Failed to load spooled batches')
+            self.rollback(err, self.DROP_STAGE)
+            raise
+        return len(new)
+
+    def update_rollups(self, cursor, data):
+        """
+        Adds counters of inserted rows to domain_hour and url_totals,
+        must be called in the same transaction as the insert
+        Rows are counted in the hour their url was created, as in
+        rebuild_rollups, so links written late or replayed from the spool
+        go to the hour of their crawl. Rows of deleted urls are skipped
+        :Parameters:
+            - `cursor`: pymysql.cursor
+            - `data`: list of tuple(domain, ip, url_id, counter)
+        """
+        url_totals = Counter()
+        for domain, ip, url_id, counter in data:
+            url_totals[url_id] += counter
+        if not url_totals:
+            return
+
+        cursor.execute(self.FETCH_URL_HOURS, (HOUR_FORMAT, list(url_totals)))
+        hours = dict(cursor.fetchall())
+        domains = Counter()
+        for domain, ip, url_id, counter in data:
+            if url_id in hours:
+                domains[(domain, hours[url_id])] += counter
+
+        cursor.executemany(self.UPSERT_DOMAIN_HOUR,
+                           [(domain, hour, counter)
+                            for (domain, hour), counter in domains.items()])
+        cursor.executemany(self.UPSERT_URL_TOTAL, url_totals.items())
+
+    def rebuild_rollups(self):
+        """
+        Fills empty rollup tables from domain_ip, used once for the data
+        inserted before rollups were introduced
+        """
+        with self.connection.cursor() as cursor:
+            cursor.execute(self.REBUILD_DOMAIN_HOUR)
+            cursor.execute(self.REBUILD_URL_TOTAL)
+            self.connection.commit()
+
+    def top_domains(self, hours=1, limit=10):
+        """
+        :Parameters:
+            - `hours`: int length of the period, links are counted
+              by the creation time of their urls
+            - `limit`: int number of domains
+        :Return:
+            list of tuple(domain, counter) ordered by counter
+        """
+        since = datetime.datetime.now() - datetime.timedelta(hours=hours)
+        with self.connection.cursor() as cursor:
+            cursor.execute(self.TOP_DOMAINS,
+                           (since.strftime(HOUR_FORMAT), limit))
+            return list(cursor.fetchall())
+
+    def url_totals(self, url_ids):
+        """
+        :Parameters:
+            - `url_ids`: list of int
+        :Return:
+            dict[url_id, int] total number of links
+        """
+        with self.connection.cursor() as cursor:
+            cursor.execute(self.FETCH_URL_TOTALS, (url_ids,))
+            return dict(cursor.fetchall())
+
+    def existing_url_ids(self, url_ids):
+        """
+        :Parameters:
+            - `url_ids`: list of int
+        :Return:
+            set of int ids that are still in urls
+        """
+        if not url_ids:
+            return set()
+        with self.connection.cursor() as cursor:
+            cursor.execute(self.FETCH_EXISTING_URL_IDS, (list(url_ids),))
+            return set(url_id for url_id, in cursor.fetchall())
+
+    def apply_deltas(self, links):
+        """
+        Replaces links of urls with the new ones, writes only rows
+        that were added, removed or changed since the last write
+        Rollups get the difference of counters. domain_hour counts links
+        of urls by the hour the url was created, so the difference goes to
+        the hour that holds the previous links of the url: totals of the
+        hour stay the current links of its urls, as after rebuild_rollups,
+        and re-crawled url whose links did not change adds nothing
+        :Parameters:
+            - `links`: list of tuple(url_id, records.LinkBatch)
+        :Return:
+            dict with numbers of upserted and deleted rows
+        """
+        current = {}
+        for url_id, batch in links:
+            for domain, ip, _, counter in batch:
+                current[(domain, ip, url_id)] = counter
+
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute(self.FETCH_URL_LINKS,
+                               ([url_id for url_id, _ in links],))
+                previous = dict(((domain, ip, url_id), counter)
+                                for url_id, domain, ip, counter
+                                in cursor.fetchall())
+
+                upserts = [key + (counter,)
+                           for key, counter in current.items()
+                           if previous.get(key) != counter]
+                deletes = [key for key in previous if key not in current]
+                deltas = [key + (counter - previous.get(key, 0),)
+                          for key, counter in current.items()]
+                deltas += [key + (-previous[key],) for key in deletes]
+
+                cursor.executemany(self.SET_PACKED_LINK, upserts)
+                cursor.executemany(self.DELETE_LINK, deletes)
+                self.update_rollups(cursor,
+                                    [row for row in deltas if row[3]])
+                self.connection.commit()
+
+        except MySQLError as err:
+            logging.exception('Failed to apply deltas of %s urls', len(links))
+            self.rollback(err)
+            raise
+
+        return {'upserted': len(upserts), 'deleted': len(deletes)}
 
     def get_url_ids(self, urls, timestamp):
         """
@@ -113,6 +493,41 @@ class DBAPI(object):
 
         return d
 
+    def iter_domain_ips(self, since=None, until=None, url=None,
+                        batch_size=1000):
+        """
+        Streams rows of domain_ip joined with urls using server side cursor,
+        so rows are not loaded into memory at once
+        :Parameters:
+            - `since`: str creation time of urls to start from
+            - `until`: str creation time of urls to stop before
+            - `url`: str to export only one url
+            - `batch_size`: int number of rows fetched at once
+        :Return:
+            generator of tuple(url_id, url, creation_time, domain, ip,
+            counter)
+        """
+        query, conditions, params = self.EXPORT_DOMAIN_IPS, [], []
+        if since:
+            conditions.append('urls.creation_time >= %s')
+            params.append(since)
+        if until:
+            conditions.append('urls.creation_time < %s')
+            params.append(until)
+        if url:
+            conditions.append('urls.url = %s')
+            params.append(url)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+
+        with self.connection.cursor(SSCursor) as cursor:
+            cursor.execute(query, params)
+            rows = cursor.fetchmany(batch_size)
+            while rows:
+                for row in rows:
+                    yield row
+                rows = cursor.fetchmany(batch_size)
+
     def insert_domain_ip(self, domain, ip, counter, url_id):
         """
         :Parameters:
@@ -148,6 +563,39 @@ class DBAPI(object):
         return timestamp
 
 
+def infile(data):
+    """
+    Writes rows into the temporary file for LOAD DATA LOCAL INFILE
+    :Parameters:
+        - `data`: iterable of tuple(domain, ip, url_id, counter),
+          ip is either packed int or dotted-quad str
+    :Return:
+        tempfile.NamedTemporaryFile removed when it is closed
+    """
+    f = tempfile.NamedTemporaryFile(prefix='domain_ip')
+    for domain, ip, url_id, counter in data:
+        if not isinstance(ip, (int, long)):
+            ip = ip_to_int(ip)
+        f.write('%s\t%s\t%s\t%s\n' % (
+            escape_infile(domain), ip, url_id, counter))
+    f.flush()
+    return f
+
+
+def escape_infile(value):
+    """
+    Escapes value for the default format of LOAD DATA INFILE
+    :Parameters:
+        - `value`: str
+    :Return:
+        str
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace(
+        '\n', '\\n')
+
+
 def get_db_api(settings):
     """
     Function that returns encapsulated db object
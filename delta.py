@@ -0,0 +1,181 @@
+"""
+Module for incremental writes of re-crawled urls
+
+Fingerprint of the last written link set is kept for every url,
+url whose links did not change costs one comparison and no writes.
+Changed urls are diffed against their rows in db and only added,
+removed or changed rows are written, see db_api.DBAPI.apply_deltas
+Url keeps its url_id between crawls while the url row exists
+
+Pages that have no links at all are not seen by the writer,
+so their previous links stay in db
+"""
+
+import cPickle
+import hashlib
+import logging
+import os
+import threading
+
+from itertools import groupby
+from operator import itemgetter
+
+from records import LinkBatch, ip_to_int
+
+
+class FingerprintStore(object):
+    """
+    Url ids and fingerprints of the last written links of urls
+    """
+
+    def __init__(self, path=None):
+        """
+        :Parameters:
+            - `path`: str path to the file to persist fingerprints, optional
+        """
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(
+            ('unchanged', 'changed', 'upserted', 'deleted'), 0)
+
+        if path and os.path.exists(path):
+            self.load()
+
+    @staticmethod
+    def fingerprint(batch):
+        """
+        :Parameters:
+            - `batch`: records.LinkBatch
+        :Return:
+            str digest of the link set
+        """
+        digest = hashlib.md5()
+        for row in sorted(batch):
+            digest.update(repr(row))
+        return digest.digest()
+
+    def url_ids(self, urls):
+        """
+        :Parameters:
+            - `urls`: iterable of str
+        :Return:
+            dict[url, url_id] of urls written before
+        """
+        with self.lock:
+            return dict((url, self.entries[url][0]) for url in urls
+                        if url in self.entries)
+
+    def unchanged(self, url, url_id, digest):
+        """
+        :Parameters:
+            - `url`: str
+            - `url_id`: int
+            - `digest`: str fingerprint of the new links
+        :Return:
+            bool True if the same links were written for the url_id
+        """
+        with self.lock:
+            unchanged = self.entries.get(url) == (url_id, digest)
+            self.counters['unchanged' if unchanged else 'changed'] += 1
+        return unchanged
+
+    def writer(self, db):
+        """
+        :Parameters:
+            - `db`: db_api.DBAPI
+        :Return:
+            callable that takes list of tuple(url, url_id, LinkBatch,
+            digest), writes deltas and remembers the fingerprints
+        """
+        def write(items):
+            result = db.apply_deltas([(url_id, batch)
+                                      for _, url_id, batch, _ in items])
+            with self.lock:
+                for url, url_id, _, digest in items:
+                    self.entries[url] = (url_id, digest)
+                self.counters['upserted'] += result['upserted']
+                self.counters['deleted'] += result['deleted']
+
+        return write
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                self.entries = dict(cPickle.load(f))
+        except (EnvironmentError, cPickle.UnpicklingError, EOFError):
+            logging.exception('Failed to load fingerprints %s', self.path)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            items = self.entries.items()
+        tmp = '%s.%s.tmp' % (self.path, threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            cPickle.dump(items, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.path)
+
+    def stats(self):
+        """
+        :Return:
+            dict
+        """
+        with self.lock:
+            return dict(self.counters, entries=len(self.entries))
+
+
+def url_batches(data, url_ids, grouped=True):
+    """
+    :Parameters:
+        - `data`: iterable of tuple(url, HostingInfo)
+        - `url_ids`: dict[url, url_id]
+        - `grouped`: bool links of every url are consecutive in data,
+          otherwise links are collected in memory until data is exhausted
+    :Return:
+        generator of tuple(url, LinkBatch) with all links of the url
+    """
+    if grouped:
+        for url, rows in groupby(data, itemgetter(0)):
+            batch = LinkBatch()
+            for _, info in rows:
+                batch.add(info.domain, ip_to_int(info.ip), url_ids[url])
+            yield url, batch
+        return
+
+    batches = {}
+    for url, info in data:
+        batch = batches.get(url)
+        if batch is None:
+            batch = batches[url] = LinkBatch()
+        batch.add(info.domain, ip_to_int(info.ip), url_ids[url])
+    for url, batch in batches.iteritems():
+        yield url, batch
+
+
+def write_deltas(writer, fingerprints, data, url_ids, grouped=True,
+                 progress=None):
+    """
+    Queues links of urls whose links changed since the last write
+    :Parameters:
+        - `writer`: writer.DBWriter that writes with fingerprints.writer
+        - `fingerprints`: FingerprintStore
+        - `data`: iterable of tuple(url, HostingInfo)
+        - `url_ids`: dict[url, url_id]
+        - `grouped`: bool links of every url are consecutive in data
+        - `progress`: progress.Progress
+    """
+    for url, batch in url_batches(data, url_ids, grouped):
+        url_id = url_ids[url]
+        digest = fingerprints.fingerprint(batch)
+        links = sum(counter for _, _, _, counter in batch)
+        if progress:
+            progress.count('links', links)
+            progress.emit('links', url=url, found=links)
+        if fingerprints.unchanged(url, url_id, digest):
+            continue
+        if progress:
+            progress.call('insert', writer.put,
+                          [(url, url_id, batch, digest)])
+        else:
+            writer.put([(url, url_id, batch, digest)])
@@ -0,0 +1,146 @@
+"""
+Module for exporting parsed links in bulk
+
+Rows are streamed from the db, so memory usage does not depend
+on the number of exported rows
+"""
+
+import argparse
+import csv
+import gzip
+import json
+import logging
+import sys
+import time
+
+import db_api
+from local import settings
+
+FIELDS = ('url_id', 'url', 'creation_time', 'domain', 'ip', 'counter')
+FORMATS = ('csv', 'ndjson')
+REPORT_EVERY = 1000000
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def write_csv(rows, f):
+    """
+    :Parameters:
+        - `rows`: iterable of tuple
+        - `f`: file
+    :Return:
+        generator of rows written
+    """
+    writer = csv.writer(f)
+    writer.writerow(FIELDS)
+    for row in rows:
+        writer.writerow([_encode(value) for value in row])
+        yield row
+
+
+def write_ndjson(rows, f):
+    """
+    :Parameters:
+        - `rows`: iterable of tuple
+        - `f`: file
+    :Return:
+        generator of rows written
+    """
+    for row in rows:
+        f.write(json.dumps(dict(zip(FIELDS, row)), default=str) + '\n')
+        yield row
+
+
+WRITERS = {
+    'csv': write_csv,
+    'ndjson': write_ndjson,
+}
+
+
+def open_output(path, compress=False):
+    """
+    :Parameters:
+        - `path`: str, '-' for stdout
+        - `compress`: bool gzip output
+    :Return:
+        file
+    """
+    if path == '-':
+        if compress:
+            return gzip.GzipFile(fileobj=sys.stdout, mode='wb')
+        return sys.stdout
+    if compress:
+        return gzip.open(path, 'wb')
+    return open(path, 'wb')
+
+
+def export(rows, f, fmt='csv'):
+    """
+    :Parameters:
+        - `rows`: iterable of tuple(url_id, url, creation_time, domain, ip,
+          counter)
+        - `f`: file to write to
+        - `fmt`: str one of FORMATS
+    :Return:
+        dict with number of rows, seconds and rows per second
+    """
+    start = time.time()
+    count = 0
+    for count, _ in enumerate(WRITERS[fmt](rows, f), 1):
+        if not count % REPORT_EVERY:
+            logging.info('Exported %s rows', count)
+
+    seconds = time.time() - start
+    return {
+        'rows': count,
+        'seconds': seconds,
+        'rows_per_sec': seconds and count / seconds,
+    }
+
+
+def create_parser(description=''):
+    """
+    :Parameters:
+        - `description`: str name of the parser
+    :Return:
+        argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('--output', default='-',
+                        help='File path, stdout by default')
+    parser.add_argument('--format', choices=FORMATS, default='csv',
+                        dest='fmt')
+    parser.add_argument('--gzip', action='store_true', dest='compress')
+    parser.add_argument('--since', help='Creation time of urls, inclusive')
+    parser.add_argument('--until', help='Creation time of urls, exclusive')
+    parser.add_argument('--url', help='Export only this url')
+
+    return parser
+
+
+def main():
+    """
+    The main function of the exporter
+    """
+    args = create_parser('Export of parsed links.').parse_args()
+    db = db_api.DBAPI(**settings)
+    rows = db.iter_domain_ips(since=args.since, until=args.until,
+                              url=args.url)
+
+    f = open_output(args.output, args.compress)
+    try:
+        stats = export(rows, f, args.fmt)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+    sys.stderr.write(json.dumps(stats) + '\n')
+
+
+if __name__ == '__main__':
+    main()
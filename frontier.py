@@ -0,0 +1,282 @@
+"""
+Module for recursive crawling within the seed domains
+
+Pending urls are kept in the frontier ordered by depth, urls over
+the memory limit are spilled to disk. Visited urls are remembered
+in the bloom filter, so memory used by the seen set is fixed
+"""
+
+import hashlib
+import json
+import logging
+import math
+import os
+import shutil
+import struct
+import tempfile
+
+from collections import deque
+
+from parse_pool import make_pool
+from parsing import (domain_from_url, extract_links, fetch_pages,
+                     get_url_host_ip, normalize_links)
+
+DEPTH = 1
+MAX_PAGES = 1000
+BATCH_SIZE = 50
+MEMORY_ITEMS = 100000
+CAPACITY = 10000000
+ERROR_RATE = 0.001
+
+
+class BloomFilter(object):
+    """
+    Probabilistic set with fixed memory usage
+    """
+
+    def __init__(self, capacity=CAPACITY, error_rate=ERROR_RATE):
+        """
+        :Parameters:
+            - `capacity`: int expected number of items
+            - `error_rate`: float probability of false positive
+        """
+        self.bits = int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, int(round(
+            float(self.bits) / capacity * math.log(2))))
+        self.array = bytearray(self.bits // 8 + 1)
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        first, second = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    def add(self, key):
+        """
+        :Parameters:
+            - `key`: str
+        :Return:
+            bool True if key was not in the filter
+        """
+        added = False
+        for position in self._positions(key):
+            byte, bit = divmod(position, 8)
+            if not self.array[byte] & (1 << bit):
+                self.array[byte] |= 1 << bit
+                added = True
+        return added
+
+    def __contains__(self, key):
+        return all(self.array[position // 8] & (1 << position % 8)
+                   for position in self._positions(key))
+
+
+class SpillFile(object):
+    """
+    Append-only file of pending items with sequential reading
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.writer = open(path, 'a')
+        self.offset = 0
+        self.size = 0
+
+    def append(self, item):
+        self.writer.write(json.dumps(item) + '\n')
+        self.size += 1
+
+    def read(self, count):
+        """
+        :Parameters:
+            - `count`: int maximal number of items to read
+        :Return:
+            list of items
+        """
+        self.writer.flush()
+        items = []
+        with open(self.path) as f:
+            f.seek(self.offset)
+            while len(items) < count:
+                line = f.readline()
+                if not line:
+                    break
+                items.append(tuple(json.loads(line)))
+            self.offset = f.tell()
+        self.size -= len(items)
+        return items
+
+    def close(self):
+        self.writer.close()
+
+
+class Frontier(object):
+    """
+    Queue of pending urls ordered by depth
+    """
+
+    def __init__(self, directory=None, memory_items=MEMORY_ITEMS,
+                 capacity=CAPACITY, error_rate=ERROR_RATE):
+        """
+        :Parameters:
+            - `directory`: str where spilled urls are stored
+            - `memory_items`: int maximal number of urls kept in memory
+            - `capacity`: int expected number of seen urls
+            - `error_rate`: float probability that new url is taken
+              as seen
+        """
+        self.own_directory = directory is None
+        self.directory = directory or tempfile.mkdtemp(prefix='frontier')
+        self.memory_items = memory_items
+        self.seen = BloomFilter(capacity, error_rate)
+        self.queues = {}
+        self.spills = {}
+        self.in_memory = 0
+        self.pushed = 0
+        self.popped = 0
+        self.duplicates = 0
+        self.spilled = 0
+
+    def push(self, url, seed, depth):
+        """
+        :Parameters:
+            - `url`: str
+            - `seed`: str seed url the url was found from
+            - `depth`: int
+        :Return:
+            bool True if url was not seen before
+        """
+        if not self.seen.add(url):
+            self.duplicates += 1
+            return False
+
+        self.pushed += 1
+        spill = self.spills.get(depth)
+        if self.in_memory >= self.memory_items or (spill and spill.size):
+            if spill is None:
+                spill = self.spills[depth] = SpillFile(
+                    os.path.join(self.directory, 'depth-%s' % depth))
+            spill.append((url, seed))
+            self.spilled += 1
+        else:
+            self.queues.setdefault(depth, deque()).append((url, seed))
+            self.in_memory += 1
+        return True
+
+    def pop(self):
+        """
+        :Return:
+            tuple(url, seed, depth) with the lowest depth or None
+        """
+        depths = [depth for depth, queue in self.queues.items() if queue]
+        depths += [depth for depth, spill in self.spills.items()
+                   if spill.size]
+        if not depths:
+            return None
+
+        depth = min(depths)
+        queue = self.queues.setdefault(depth, deque())
+        if not queue:
+            items = self.spills[depth].read(self.memory_items)
+            queue.extend(items)
+            self.in_memory += len(items)
+
+        url, seed = queue.popleft()
+        self.in_memory -= 1
+        self.popped += 1
+        return url, seed, depth
+
+    def __len__(self):
+        return self.pushed - self.popped
+
+    def stats(self):
+        """
+        :Return:
+            dict
+        """
+        total = self.pushed + self.duplicates
+        return {
+            'size': len(self),
+            'in_memory': self.in_memory,
+            'spilled': self.spilled,
+            'pushed': self.pushed,
+            'duplicates': self.duplicates,
+            'duplicate_rate': total and float(self.duplicates) / total,
+        }
+
+    def close(self):
+        for spill in self.spills.values():
+            spill.close()
+        if self.own_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def crawl(seeds, depth=DEPTH, max_pages=MAX_PAGES, frontier=None,
+          workers=None, scheduler=None, cache=None, memo=None,
+          timeouts=None, progress=None, archive=None, replay=None,
+          pool=None):
+    """
+    Crawls pages of seed domains up to depth
+    :Parameters:
+        - `seeds`: list of str
+        - `depth`: int maximal depth of the crawl, 0 for seeds only
+        - `max_pages`: int maximal number of pages to fetch
+        - `frontier`: Frontier
+        - `workers`: int number of parsing processes
+        - `scheduler`: scheduler.HostScheduler
+        - `cache`: http_cache.ResponseCache
+        - `memo`: link_memo.LinkMemo
+        - `timeouts`: timeouts.HostTimeouts
+        - `progress`: progress.Progress
+        - `archive`: archive.PageArchive to record fetched pages
+        - `replay`: archive.PageArchive to read pages from instead of
+          fetching them
+        - `pool`: multiprocessing.Pool made by parse_pool.make_pool,
+          otherwise the pool is created once for the whole crawl
+    :Return:
+        generator of (seed, (link, domain, ip))
+    """
+    own_frontier = frontier is None
+    if own_frontier:
+        frontier = Frontier()
+    own_pool = pool is None
+    if own_pool:
+        pool = make_pool(workers)
+
+    for seed in seeds:
+        frontier.push(seed, seed, 0)
+
+    pages = 0
+    try:
+        while pages < max_pages and len(frontier):
+            batch = {}
+            while len(batch) < min(BATCH_SIZE, max_pages - pages):
+                item = frontier.pop()
+                if item is None:
+                    break
+                url, seed, level = item
+                batch[url] = (seed, level)
+            pages += len(batch)
+
+            if replay:
+                fetched = replay.pages(list(batch))
+            else:
+                fetched = fetch_pages(list(batch), scheduler, cache,
+                                      timeouts, progress, archive)
+            for url, hrefs in extract_links(fetched, workers=workers,
+                                            memo=memo, pool=pool):
+                seed, level = batch[url]
+                seed_domain = domain_from_url(seed)
+                for link in normalize_links(url, hrefs):
+                    result = get_url_host_ip(link)
+                    yield seed, result
+                    if level < depth and result.domain == seed_domain:
+                        frontier.push(link, seed, level + 1)
+
+            logging.info('Frontier stats: %s', frontier.stats())
+    finally:
+        if own_frontier:
+            frontier.close()
+        if own_pool and pool:
+            pool.terminate()
+            pool.join()
@@ -0,0 +1,246 @@
+"""
+Module for caching http responses on disk
+
+Fresh responses are served from the cache, stale ones are revalidated
+with conditional requests and reused on 304 Not Modified
+
+Time of the last use of the entry is kept as mtime of its body,
+so least recently used entries are evicted first after restart too
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from collections import namedtuple
+from email.utils import mktime_tz, parsedate_tz
+
+MAX_BYTES = 512 * 1024 * 1024
+FRESHNESS = 3600
+
+CachedResponse = namedtuple('CachedResponse',
+                            ('status_code', 'content', 'headers'))
+
+MAX_AGE = re.compile(r'max-age=(\d+)')
+
+
+def freshness(headers, default=FRESHNESS):
+    """
+    :Parameters:
+        - `headers`: dict of response headers
+        - `default`: int seconds when response does not specify lifetime
+    :Return:
+        int seconds the response stays fresh, None if it must not be stored
+    """
+    cache_control = headers.get('Cache-Control') or ''
+    if 'no-store' in cache_control:
+        return None
+    if 'no-cache' in cache_control:
+        return 0
+
+    max_age = MAX_AGE.search(cache_control)
+    if max_age:
+        return int(max_age.group(1))
+
+    expires = headers.get('Expires') and parsedate_tz(headers['Expires'])
+    if expires:
+        return max(int(mktime_tz(expires) - time.time()), 0)
+
+    return default
+
+
+class ResponseCache(object):
+    """
+    Size bounded on-disk cache of responses keyed by url
+    """
+
+    def __init__(self, directory, max_bytes=MAX_BYTES, default=FRESHNESS):
+        """
+        :Parameters:
+            - `directory`: str path to the cache directory
+            - `max_bytes`: int maximal size of cached bodies
+            - `default`: int seconds of freshness when response
+              does not specify it
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.default = default
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'revalidated': 0, 'misses': 0,
+                         'evicted': 0, 'bytes_saved': 0}
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.index = self._load_index()
+        self.size = sum(meta['size'] for meta in self.index.values())
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def _load_index(self):
+        index = {}
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            key = name[:-len('.json')]
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    meta = json.load(f)
+                meta['used'] = os.path.getmtime(self._path(key, '.body'))
+            except (EnvironmentError, ValueError):
+                logging.exception('Broken cache entry %s', name)
+                continue
+            index[key] = meta
+        return index
+
+    @staticmethod
+    def key(url):
+        """
+        :Parameters:
+            - `url`: str
+        :Return:
+            str name of the cache entry
+        """
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return hashlib.sha1(url).hexdigest()
+
+    def _write(self, path, data):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+    def _read(self, key):
+        try:
+            with open(self._path(key, '.body'), 'rb') as f:
+                return f.read()
+        except EnvironmentError:
+            logging.exception('Missing cached body of %s', key)
+
+    def _touch(self, key):
+        try:
+            os.utime(self._path(key, '.body'), None)
+        except OSError:
+            pass
+
+    def _remove(self, key):
+        meta = self.index.pop(key, None)
+        if meta:
+            self.size -= meta['size']
+        for extension in ('.json', '.body'):
+            try:
+                os.remove(self._path(key, extension))
+            except OSError:
+                pass
+
+    def _store(self, key, url, response, lifetime):
+        meta = {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'expires': time.time() + lifetime,
+            'size': len(response.content),
+            'used': time.time(),
+        }
+        with self.lock:
+            self._remove(key)
+            self._write(self._path(key, '.body'), response.content)
+            self._write(self._path(key, '.json'), json.dumps(meta))
+            self.index[key] = meta
+            self.size += meta['size']
+            self._evict()
+
+    def _evict(self):
+        if self.size <= self.max_bytes:
+            return
+        for key in sorted(self.index, key=lambda k: self.index[k]['used']):
+            self._remove(key)
+            self.counters['evicted'] += 1
+            if self.size <= self.max_bytes:
+                break
+
+    def fetch(self, url, request):
+        """
+        :Parameters:
+            - `url`: str
+            - `request`: callable that takes url and headers
+              and returns response
+        :Return:
+            response or CachedResponse
+        """
+        key = self.key(url)
+        with self.lock:
+            meta = self.index.get(key)
+            if meta:
+                meta['used'] = time.time()
+
+        if meta and meta['expires'] > time.time():
+            content = self._read(key)
+            if content is not None:
+                self._touch(key)
+                self._count('hits', len(content))
+                return CachedResponse(200, content, {})
+
+        headers = {}
+        if meta and meta['etag']:
+            headers['If-None-Match'] = meta['etag']
+        if meta and meta['last_modified']:
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        response = request(url, headers=headers)
+
+        if response.status_code == 304 and meta:
+            content = self._read(key)
+            if content is not None:
+                self._touch(key)
+                self._count('revalidated', len(content))
+                lifetime = freshness(response.headers, self.default)
+                with self.lock:
+                    meta['expires'] = time.time() + (lifetime or 0)
+                    self._write(self._path(key, '.json'), json.dumps(meta))
+                return CachedResponse(200, content, response.headers)
+
+            # body was evicted after the conditional request was sent
+            with self.lock:
+                if self.index.get(key) is meta:
+                    self._remove(key)
+            response = request(url, headers={})
+
+        self._count('misses')
+        if response.status_code == 200:
+            lifetime = freshness(response.headers, self.default)
+            if lifetime is not None:
+                self._store(key, url, response, lifetime)
+        return response
+
+    def wrap(self, request):
+        """
+        :Parameters:
+            - `request`: callable that takes url and headers
+        :Return:
+            callable that takes url and uses the cache
+        """
+        return lambda url: self.fetch(url, request)
+
+    def _count(self, name, saved=0):
+        with self.lock:
+            self.counters[name] += 1
+            self.counters['bytes_saved'] += saved
+
+    def stats(self):
+        """
+        :Return:
+            dict of cache stats including hit rate
+        """
+        with self.lock:
+            stats = dict(self.counters, entries=len(self.index),
+                         size=self.size)
+        total = stats['hits'] + stats['revalidated'] + stats['misses']
+        stats['hit_rate'] = total and float(
+            stats['hits'] + stats['revalidated']) / total
+        return stats
@@ -1,78 +1,359 @@
 """
 Example of writing parsed info into db
 """
+import argparse
 import sys
+import time
 
 import logging
-from collections import Counter
+
+from functools import partial
 
 import db_api
+from archive import PageArchive
+from delta import FingerprintStore, write_deltas
+from frontier import MAX_PAGES, crawl
+from parse_pool import make_pool
 from parsing import data_from_urls
 from utils import split_every
-from local import settings
+from writer import DBWriter
+from http_cache import ResponseCache
+from link_memo import LinkMemo
+from local import (archive_path, cache_dir, fetch_concurrency,
+                   fingerprint_path, memo_path, settings, spool_dir)
+from records import batch_from
+from scheduler import HostScheduler
+from seeds import WINDOW, Checkpoint, open_seeds, windows
+from spool import Spool
 
 BATCH_SIZE = 10
 
 
-def group(lst):
+def main():
     """
-    Function that groups lst by (domain, ip) and counter number
-    of occurencs of all (domain, ip)
-    :param lst: list of tuple(url, HostInfo)
-    :return: dict[tuple(domain, ip, url), int]
+    First we insert urls into db, so we know their ids
+    before starting parsing
+    After that we group output by BATCH_SIZE
+    Seeds from the file are processed by windows of --window urls
+    :return:
     """
-    return Counter((host_info.domain, host_info.ip, url) for url, host_info in
-                   lst)
+    parser = create_parser('Fetching of seed urls.')
+    args = parser.parse_args()
+    archive = PageArchive(archive_path) if archive_path else None
+    fingerprints = fingerprint_path and FingerprintStore(fingerprint_path)
+    kwargs = dict(cache=get_cache(), memo=LinkMemo(memo_path or None),
+                  archive=archive, fingerprints=fingerprints or None,
+                  spool=Spool(spool_dir) if spool_dir else None,
+                  scheduler=get_scheduler(args.concurrency))
 
+    if not args.seeds:
+        fetch_urls(args.urls, **kwargs)
+        return
 
-def prepare(groupped, url_ids):
-    """
+    if args.checkpoint and args.seeds == '-':
+        parser.error('--checkpoint can not be used with seeds from stdin')
+    checkpoint = args.checkpoint and Checkpoint(args.checkpoint, args.seeds)
+    f = open_seeds(args.seeds)
+    try:
+        stats = fetch_seeds(f, args.window, checkpoint or None, **kwargs)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    logging.info('Seeds stats: %s', stats)
+    if stats['stopped']:
+        sys.exit(1)
 
-    :Parameters:
-         - `groupped`: dict[tuple(domain, ip, url), int]
-         - `url_ids`: dict[url, url_id]
-    :return: list of tuple(domain, ip, url, counter)
-    """
 
-    for (domain, ip, url), counter in groupped.items():
-        yield domain, ip, url_ids[url], counter
+def get_cache():
+    """
+    :return: http_cache.ResponseCache or None if cache is not configured
+    """
+    if cache_dir:
+        return ResponseCache(cache_dir)
 
 
-def main():
+def get_scheduler(concurrency=None):
     """
-    First we insert urls into db, so we know their ids
-    before starting parsing
-    After that we group output by BATCH_SIZE
-    :return:
+    :param concurrency: int number of concurrent requests,
+                        FETCH_CONCURRENCY by default
+    :return: scheduler.HostScheduler or None to fetch pages one by one
     """
-    urls = sys.argv[1:]
-    fetch_urls(urls)
+    if concurrency is None:
+        concurrency = fetch_concurrency
+    if concurrency > 1:
+        return HostScheduler(concurrency=concurrency)
 
 
-def fetch_urls(urls):
+def insert_urls(db, urls):
     """
-    Fetches urls and inserts them into db
-    :param urls: list of str
+    Inserts urls into db, so we know their ids before parsing
+    :param db: db_api.DBAPI
+    :param urls: set of str
+    :return: dict[url, url_id] or None if urls were not inserted
     """
-    urls = set(urls)
-    db = db_api.DBAPI(**settings)
     timestamp = db.insert_urls(urls)  # type: str
     try:
-        url_ids = db.get_url_ids(urls, timestamp)
+        return db.get_url_ids(urls, timestamp)
     except Exception as e:
         logging.exception('Failed to insert urls in db, exiting program ..')
-        return
 
-    for lst in split_every(BATCH_SIZE, data_from_urls(urls)):
+
+def insert_new_urls(db, urls, fingerprints):
+    """
+    Reuses ids of urls written before, inserts only the new urls
+    :param db: db_api.DBAPI
+    :param urls: set of str
+    :param fingerprints: delta.FingerprintStore
+    :return: dict[url, url_id] or None if urls were not inserted
+    """
+    known = fingerprints.url_ids(urls)
+    existing = db.existing_url_ids(known.values())
+    url_ids = dict((url, url_id) for url, url_id in known.items()
+                   if url_id in existing)
+
+    new = urls.difference(url_ids)
+    if new:
+        new_ids = insert_urls(db, new)
+        if new_ids is None:
+            return
+        url_ids.update(new_ids)
+    return url_ids
+
+
+def write_batches(writer, data, url_ids, batch_size=BATCH_SIZE,
+                  progress=None):
+    """
+    Queues links to the writer in packs of batch_size
+    :param writer: writer.DBWriter
+    :param data: iterable of tuple(url, HostingInfo)
+    :param url_ids: dict[url, url_id]
+    :param batch_size: int
+    :param progress: progress.Progress
+    """
+    for lst in split_every(batch_size, data):
         """
-        Process in packs of BATCH_SIZE
+        Process in packs of batch_size
         We group items by their (domain, ip)
         """
         logging.info('Saving %s into db', lst)
-        groupped = group(lst)
+        if progress:
+            progress.call('insert', writer.put, batch_from(lst, url_ids))
+            progress.count('links', len(lst))
+            progress.emit('links', inserted=len(lst))
+        else:
+            writer.put(batch_from(lst, url_ids))
+
+
+def fetch_urls(urls, parse_workers=None, scheduler=None, cache=None,
+               memo=None, depth=0, max_pages=MAX_PAGES, batch_size=BATCH_SIZE,
+               timeouts=None, progress=None, archive=None, replay=None,
+               fingerprints=None, spool=None, parse_pool=None, db=None,
+               writer=None):
+    """
+    Fetches urls and inserts them into db
+    :param urls: list of str
+    :param parse_workers: int number of parsing processes
+    :param scheduler: scheduler.HostScheduler to fetch pages concurrently
+    :param cache: http_cache.ResponseCache to reuse cached pages
+    :param memo: link_memo.LinkMemo to skip parsing of known pages,
+                 persisted at the end of the job
+    :param depth: int depth of the crawl within seed domains,
+                  0 to parse only the seed pages
+    :param max_pages: int maximal number of pages of recursive crawl
+    :param batch_size: int number of links queued to the writer at once,
+                       batches queued during a commit are written together,
+                       groups over db_api.BULK_THRESHOLD are loaded with
+                       LOAD DATA
+    :param timeouts: timeouts.HostTimeouts to adapt timeouts to latency
+                     of hosts
+    :param progress: progress.Progress to report pages, links and time
+                     of fetch, parse (including ip lookup) and insert,
+                     which is time spent waiting for the full writer queue
+    :param archive: archive.PageArchive to record fetched pages
+    :param replay: archive.PageArchive to reprocess recorded pages
+                   instead of fetching them
+    :param fingerprints: delta.FingerprintStore to write only links that
+                         changed since the last crawl of the url,
+                         persisted at the end of the job
+    :param spool: spool.Spool to keep links that were not written
+                  because db is slow or unavailable, replayed with
+                  spool.replay
+    :param parse_pool: multiprocessing.Pool made by parse_pool.make_pool
+                       shared by jobs, parse_workers tasks are kept in
+                       flight
+    :param db: db_api.DBAPI shared by calls, closed by the caller
+    :param writer: writer.DBWriter made by make_writer, shared by calls
+                   and closed by the caller. It owns its db, the
+                   connection is not shared with db. memo and
+                   fingerprints are saved by the caller then
+    :return: dict stats of the writer or None if urls were not inserted
+    """
+    urls = set(urls)
+    own_db = db is None
+    if own_db:
+        db = db_api.DBAPI(**settings)
+    try:
+        return _fetch_urls(urls, db, writer, parse_workers, scheduler, cache,
+                           memo, depth, max_pages, batch_size, timeouts,
+                           progress, archive, replay, fingerprints, spool,
+                           parse_pool)
+    finally:
+        if own_db:
+            db.close()
+
+
+def make_writer(db, fingerprints=None, spool=None):
+    """
+    :param db: db_api.DBAPI
+    :param fingerprints: delta.FingerprintStore to write deltas
+    :param spool: spool.Spool for links that were not written
+    :return: started writer.DBWriter
+    """
+    if fingerprints:
+        return DBWriter(db, write=fingerprints.writer(db)).start()
+    return DBWriter(db, spool=spool).start()
+
+
+def _fetch_urls(urls, db, writer, parse_workers, scheduler, cache, memo,
+                depth, max_pages, batch_size, timeouts, progress, archive,
+                replay, fingerprints, spool, parse_pool):
+    if fingerprints:
+        url_ids = insert_new_urls(db, urls, fingerprints)
+    else:
+        url_ids = insert_urls(db, urls)
+    if url_ids is None:
+        return
+
+    if depth:
+        data = crawl(urls, depth, max_pages, workers=parse_workers,
+                     scheduler=scheduler, cache=cache, memo=memo,
+                     timeouts=timeouts, progress=progress, archive=archive,
+                     replay=replay, pool=parse_pool)
+    else:
+        data = data_from_urls(urls, parse_workers, scheduler, cache, memo,
+                              timeouts, progress, archive, replay,
+                              parse_pool)
+    if progress:
+        data = progress.timed('parse', data)
+
+    own_writer = writer is None
+    if own_writer:
+        writer = make_writer(db, fingerprints, spool)
+    try:
+        if fingerprints:
+            write_deltas(writer, fingerprints, data, url_ids,
+                         grouped=not depth, progress=progress)
+        else:
+            write_batches(writer, data, url_ids, batch_size, progress)
+    finally:
+        stats = writer.close() if own_writer else writer.stats()
+        logging.info('Writer stats: %s', stats)
+        if progress:
+            progress.emit('writer', **stats)
+
+    if fingerprints:
+        logging.info('Fingerprint stats: %s', fingerprints.stats())
+    # with the shared writer the caller saves them once at the end
+    if own_writer:
+        if memo:
+            memo.save()
+        if fingerprints:
+            fingerprints.save()
+    return stats
+
+
+def fetch_seeds(f, window=WINDOW, checkpoint=None, **kwargs):
+    """
+    Fetches seeds read from the file window by window
+    Urls are deduplicated and inserted per window. Windows share one db
+    connection for urls, one writer with its own connection, so links
+    of the window are written while the next one is fetched, and one
+    parsing pool. Checkpoint is saved by the writer after links of the
+    window are written, it is not moved after links were lost
+    :param f: file with one url per line
+    :param window: int number of lines processed at once
+    :param checkpoint: seeds.Checkpoint to resume interrupted run
+    :param kwargs: passed to fetch_urls
+    :return: dict stats, stopped is True if urls of the window
+             were not inserted or links were not written
+    """
+    stats = {'windows': 0, 'lines': 0, 'urls': 0, 'duplicates': 0,
+             'stopped': False}
+    start = time.time()
+    skip = checkpoint.lines if checkpoint else 0
+    if skip:
+        logging.info('Resuming seeds after line %s', skip)
+
+    own_pool = kwargs.get('parse_pool') is None
+    if own_pool:
+        # forked before the writer thread is started
+        kwargs['parse_pool'] = make_pool(kwargs.get('parse_workers'))
+    db = db_api.DBAPI(**settings)
+    writer = make_writer(db_api.DBAPI(**settings), kwargs.get('fingerprints'),
+                         kwargs.get('spool'))
+    try:
+        for position, urls in windows(f, window, skip):
+            unique = set(urls)
+            if unique and fetch_urls(unique, db=db, writer=writer,
+                                     **kwargs) is None:
+                logging.error('Stopped at line %s, run again to resume',
+                              skip)
+                stats['stopped'] = True
+                break
+
+            stats['windows'] += 1
+            stats['lines'] += position - skip
+            stats['urls'] += len(unique)
+            stats['duplicates'] += len(urls) - len(unique)
+            skip = position
+            if checkpoint:
+                writer.after(partial(checkpoint.save, position))
+            logging.info('Processed %s lines of seeds', position)
+    finally:
+        try:
+            stats['writer'] = writer.close()
+        finally:
+            writer.db.close()
+            db.close()
+            if own_pool and kwargs['parse_pool']:
+                kwargs['parse_pool'].terminate()
+                kwargs['parse_pool'].join()
+        if kwargs.get('memo'):
+            kwargs['memo'].save()
+        if kwargs.get('fingerprints'):
+            # fingerprints of the last window are known after close
+            kwargs['fingerprints'].save()
+
+    if stats['writer']['lost']:
+        logging.error('Links of %s groups were not written, run again to '
+                      'resume', stats['writer']['lost'])
+        stats['stopped'] = True
+
+    stats['seconds'] = time.time() - start
+    if checkpoint and not stats['stopped']:
+        checkpoint.clear()
+    return stats
+
+
+def create_parser(description=''):
+    """
+    :param description: str name of the parser
+    :return: argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('urls', nargs='*')
+    parser.add_argument('--seeds', help='File with one url per line, '
+                        '- for stdin, .gz files are decompressed')
+    parser.add_argument('--window', type=int, default=WINDOW,
+                        help='Number of seeds processed at once')
+    parser.add_argument('--checkpoint', help='Path to the checkpoint file '
+                        'to resume interrupted run of seeds')
+    parser.add_argument('--concurrency', type=int,
+                        help='Number of concurrent requests, '
+                        'FETCH_CONCURRENCY by default')
 
-        prepared_data = list(prepare(groupped, url_ids))
-        db.insert(prepared_data)
+    return parser
 
 
 if __name__ == '__main__':
@@ -0,0 +1,147 @@
+"""
+Module for memoizing links extracted from page bodies
+
+Pages with the same body are parsed only once, even when they are
+reached via different urls or in different crawls
+"""
+
+import cPickle
+import hashlib
+import logging
+import os
+import threading
+
+from collections import deque, OrderedDict
+
+MAX_ENTRIES = 100000
+
+
+class LinkMemo(object):
+    """
+    LRU of extracted links keyed by hash of the page body
+    """
+
+    def __init__(self, path=None, max_entries=MAX_ENTRIES):
+        """
+        :Parameters:
+            - `path`: str path to the file to persist memo, optional
+            - `max_entries`: int maximal number of memoized pages
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+        if path and os.path.exists(path):
+            self.load()
+
+    @staticmethod
+    def key(content):
+        """
+        :Parameters:
+            - `content`: str page body
+        :Return:
+            str digest of the body
+        """
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        return hashlib.md5(content).digest()
+
+    def lookup(self, key, size=0):
+        """
+        :Parameters:
+            - `key`: str digest of the body
+            - `size`: int size of the body
+        :Return:
+            list of str hrefs or None
+        """
+        with self.lock:
+            hrefs = self.entries.pop(key, None)
+            if hrefs is None:
+                self.misses += 1
+                return None
+
+            self.entries[key] = hrefs
+            self.hits += 1
+            self.bytes_saved += size
+        return hrefs
+
+    def store(self, key, hrefs):
+        """
+        :Parameters:
+            - `key`: str digest of the body
+            - `hrefs`: list of str
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = hrefs
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def memoized(self, pages, extract):
+        """
+        Parses only pages that were not seen before
+        :Parameters:
+            - `pages`: iterable of tuple(url, content)
+            - `extract`: callable that takes pages and returns
+              generator of tuple(url, hrefs) in order of pages
+        :Return:
+            generator of tuple(url, hrefs)
+        """
+        keys = deque()
+        found = deque()
+
+        def misses():
+            for url, content in pages:
+                if not content:
+                    continue
+                key = self.key(content)
+                hrefs = self.lookup(key, len(content))
+                if hrefs is None:
+                    keys.append(key)
+                    yield url, content
+                else:
+                    found.append((url, hrefs))
+
+        for url, hrefs in extract(misses()):
+            self.store(keys.popleft(), hrefs)
+            while found:
+                yield found.popleft()
+            yield url, hrefs
+
+        while found:
+            yield found.popleft()
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                self.entries = OrderedDict(cPickle.load(f))
+        except (EnvironmentError, cPickle.UnpicklingError, EOFError):
+            logging.exception('Failed to load link memo %s', self.path)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            items = self.entries.items()
+        tmp = '%s.%s.tmp' % (self.path, threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            cPickle.dump(items, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.path)
+
+    def stats(self):
+        """
+        :Return:
+            dict
+        """
+        total = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': total and float(self.hits) / total,
+            'bytes_saved': self.bytes_saved,
+        }
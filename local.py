@@ -23,3 +23,24 @@ db = parser.get('db', 'database')
 
 settings = dict(host=host, user=username, database=db, password=password)
 
+cache_dir = os.environ.get('HTTP_CACHE_DIR', '')
+
+memo_path = os.environ.get('LINK_MEMO_PATH', '')
+
+profile_dir = os.environ.get('PROFILE_DIR', 'profiles')
+
+archive_path = os.environ.get('PAGE_ARCHIVE', '')
+
+fingerprint_path = os.environ.get('FINGERPRINT_PATH', '')
+
+spool_dir = os.environ.get('SPOOL_DIR', '')
+
+hedge_requests = os.environ.get('HEDGE_REQUESTS', '') == '1'
+
+fetch_concurrency = int(os.environ.get('FETCH_CONCURRENCY', 0))
+
+admission_settings = dict(
+    max_cpu=float(os.environ.get('ADMISSION_MAX_CPU', 85)),
+    min_memory=int(os.environ.get('ADMISSION_MIN_MEMORY_MB', 512)) << 20,
+    max_jobs=int(os.environ.get('ADMISSION_MAX_JOBS', 4)),
+    max_queue=int(os.environ.get('ADMISSION_MAX_QUEUE', 16)))
@@ -0,0 +1,148 @@
+"""
+Module for parsing pages in the pool of worker processes
+
+The pool is long-lived: it is created once by the process that runs
+many jobs, before it starts threads, and is shared by the jobs. Every
+job keeps at most WINDOW tasks per worker in flight, so pages are not
+read ahead of parsing
+"""
+
+from collections import deque
+from itertools import chain, islice
+from multiprocessing import Pool, cpu_count
+
+from parsers import parser_factory
+
+WORKERS = cpu_count()
+BATCH_BYTES = 256 * 1024
+MIN_PAGES = 8
+WINDOW = 2
+
+_parsers = {}
+
+
+def hrefs_from_content(parser, content):
+    """
+    :Parameters:
+        - `parser`: Parser class
+        - `content`: str page body
+    :Return:
+        list of str hrefs found on the page
+    """
+    hrefs = (item.get('href') for item in parser(content).find_all(href=True))
+    return [href for href in hrefs if href]
+
+
+def make_pool(workers=None):
+    """
+    :Parameters:
+        - `workers`: int number of worker processes
+    :Return:
+        multiprocessing.Pool or None when one process is enough,
+        must be terminated by the caller
+    """
+    if workers is None:
+        workers = WORKERS
+    if workers <= 1:
+        return None
+    return Pool(workers)
+
+
+def _parse_batch(parser, batch):
+    """
+    Creates parser once per worker process
+    :Parameters:
+        - `parser`: str name of the parser to use
+        - `batch`: list of tuple(url, content)
+    :Return:
+        list of tuple(url, list of hrefs)
+    """
+    if parser not in _parsers:
+        _parsers[parser] = parser_factory(parser)
+    return [(url, hrefs_from_content(_parsers[parser], content))
+            for url, content in batch]
+
+
+def batches(pages, batch_bytes=BATCH_BYTES):
+    """
+    Groups small pages together, so every task sent to the worker
+    holds at least batch_bytes of content
+    :Parameters:
+        - `pages`: iterable of tuple(url, content)
+        - `batch_bytes`: int
+    :Return:
+        generator of list of tuple(url, content)
+    """
+    batch, size = [], 0
+    for url, content in pages:
+        if not content:
+            continue
+        batch.append((url, content))
+        size += len(content)
+        if size >= batch_bytes:
+            yield batch
+            batch, size = [], 0
+    if batch:
+        yield batch
+
+
+def extract_links(pages, parser='', workers=None, batch_bytes=BATCH_BYTES,
+                  min_pages=MIN_PAGES, memo=None, pool=None):
+    """
+    Parses pages and returns hrefs of every page
+    Jobs smaller than min_pages are parsed in-process
+    :Parameters:
+        - `pages`: iterable of tuple(url, content)
+        - `parser`: str name of the parser to use
+        - `workers`: int number of worker processes, with the pool it is
+          the number of tasks the job keeps in flight
+        - `batch_bytes`: int minimal size of the task sent to the worker
+        - `min_pages`: int minimal number of pages to use the pool
+        - `memo`: link_memo.LinkMemo to skip parsing of known pages
+        - `pool`: multiprocessing.Pool made by make_pool, the pool of
+          the job is created and terminated otherwise
+    :Return:
+        generator of tuple(url, list of hrefs), in order of pages
+        unless memo is used
+    """
+    def extract(pages):
+        return _extract_links(pages, parser, workers, batch_bytes, min_pages,
+                              pool)
+
+    if memo is None:
+        return extract(pages)
+    return memo.memoized(pages, extract)
+
+
+def _extract_links(pages, parser, workers, batch_bytes, min_pages, pool):
+    if workers is None:
+        workers = WORKERS
+
+    pages = iter(pages)
+    head = list(islice(pages, min_pages))
+    pages = chain(head, pages)
+
+    if workers <= 1 or len(head) < min_pages:
+        parser = parser_factory(parser)
+        for url, content in pages:
+            if content:
+                yield url, hrefs_from_content(parser, content)
+        return
+
+    own = pool is None
+    if own:
+        pool = make_pool(workers)
+    try:
+        pending = deque()
+        for batch in batches(pages, batch_bytes):
+            pending.append(pool.apply_async(_parse_batch, (parser, batch)))
+            while len(pending) >= workers * WINDOW:
+                for item in pending.popleft().get():
+                    yield item
+        while pending:
+            for item in pending.popleft().get():
+                yield item
+    finally:
+        if own:
+            pool.terminate()
+            pool.join()
@@ -6,21 +6,57 @@ import time
 import logging
 import socket
 import sys
+import threading
 
-from functools import wraps
+from functools import partial, wraps
 from itertools import izip_longest
-from urlparse import urlparse
-from collections import namedtuple
+from urlparse import urljoin, urlparse, urlsplit, urlunsplit
 
 import requests
 
+from parse_pool import extract_links
 from parsers import parser_factory
 from patch import patch
+from utils import memoize
 
 DELAY = 1
 RETRY = 3
+TIMEOUT = 3
+DOMAIN_CACHE_SIZE = 100000
+DNS_TTL = 300
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+_domains = {}
+
+
+class HostingInfo(object):
+    """
+    Link with its ip and domain
+    """
+
+    __slots__ = ('link', 'ip', 'domain')
+
+    def __init__(self, link, ip, domain):
+        self.link = link
+        self.ip = ip
+        self.domain = domain
+
+    def __iter__(self):
+        return iter((self.link, self.ip, self.domain))
+
+    def __eq__(self, other):
+        return tuple(self) == tuple(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return 'HostingInfo(link=%r, ip=%r, domain=%r)' % tuple(self)
 
-HostingInfo = namedtuple('HostingInfo', ('link', 'ip', 'domain'))
 
 class RetryException(Exception):
     """
@@ -61,16 +97,17 @@ def retry(delay, tries):
     return wrapper
 
 
-def get_url_host_ip(url):
+def get_url_host_ip(url, resolver=None):
     """
     Function that returns triple (url, domain, ip)
     :Parameters:
        - `url`: str url
+       - `resolver`: Resolver to reuse ips of domains
     :Return:
        generator triple (url, domain, ip) only if every part is present
     """
     domain = domain_from_url(url)
-    ip = get_ip_from_url(domain)
+    ip = (resolver or get_ip_from_url)(domain)
     return HostingInfo(link=url, domain=domain, ip=ip)
 
 
@@ -88,6 +125,47 @@ def get_ip_from_url(domain):
         return '0.0.0.0'
 
 
+class Resolver(object):
+    """
+    Caches ips of domains for ttl seconds
+    Used by the worker of the coordinator, so the cache holds
+    the hosts of its shard
+    """
+
+    def __init__(self, ttl=DNS_TTL, maxsize=DOMAIN_CACHE_SIZE):
+        """
+        :Parameters:
+            - `ttl`: float seconds the ip is reused
+            - `maxsize`: int number of domains, cache is cleared
+              when it grows over it
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, domain):
+        """
+        :Parameters:
+            - `domain`: str
+        :Return:
+            str ip address
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.cache.get(domain)
+        if entry and entry[1] > now:
+            return entry[0]
+
+        ip = get_ip_from_url(domain)
+        with self.lock:
+            if len(self.cache) >= self.maxsize:
+                self.cache.clear()
+            self.cache[domain] = (ip, now + self.ttl)
+        return ip
+
+
+@memoize(DOMAIN_CACHE_SIZE)
 def domain_from_url(url):
     """
     Fetches domain from url
@@ -99,42 +177,153 @@ def domain_from_url(url):
     logging.info('Getting domain from %s', url)
 
     splitted_url = urlparse(url)
-    domain = splitted_url.netloc
+    domain = splitted_url.hostname or ''
 
-    return domain[4:] if domain.startswith('www.') else domain
+    return intern_domain(domain[4:] if domain.startswith('www.') else domain)
+
+
+def intern_domain(domain):
+    """
+    Shares one copy of every domain between links of all jobs,
+    table is cleared when it grows over DOMAIN_CACHE_SIZE
+    Works for unicode domains unlike builtin intern
+    :Parameters:
+        - `domain`: str
+    :Return:
+        str equal to the domain
+    """
+    shared = _domains.get(domain)
+    if shared is None:
+        if len(_domains) >= DOMAIN_CACHE_SIZE:
+            _domains.clear()
+        shared = _domains.setdefault(domain, domain)
+    return shared
 
 
 @retry(DELAY, RETRY)
-def request_page(url):
+def request_page(url, headers=None, timeouts=None, session=None):
     """
     :Parameters:
         - `url`: str url of the page to request
+        - `headers`: dict of additional request headers
+        - `timeouts`: timeouts.HostTimeouts to use adaptive timeout
+          of the host instead of the fixed one
+        - `session`: requests.Session to keep connections to hosts alive
 
     :Return:
         request.Response object
     """
     logging.info('Requesting url %s', url)
-    return requests.get(url, timeout=3, verify=False)
+    if timeouts:
+        return timeouts.get(url, headers, session)
+    return (session or requests).get(url, timeout=TIMEOUT, verify=False,
+                                     headers=headers)
 
 
-def request_pages(urls):
+def _request_page(request, url):
+    """
+    :Parameters:
+        - `request`: callable that requests the page
+        - `url`: str url of the page to request
+    :Return:
+        request.Response object or None if page was not retrieved
+    """
+    try:
+        return request(url)
+    except RetryException as err:
+        logging.exception('Failed to retrieve page: %s', url)
+        print('Wrong url %s' % url)
+
+
+def fetch_pages(urls, scheduler=None, cache=None, timeouts=None,
+                progress=None, archive=None, session=None):
+    """
+    Function that returns pairs of url and page content
+    Ignores exceptions
+
+    :Parameters:
+        - `urls`: list of str
+        - `scheduler`: scheduler.HostScheduler to fetch pages concurrently
+        - `cache`: http_cache.ResponseCache to reuse cached pages
+        - `timeouts`: timeouts.HostTimeouts for adaptive timeouts
+        - `progress`: progress.Progress to report fetched pages
+        - `archive`: archive.PageArchive to record responses
+        - `session`: requests.Session to keep connections to hosts alive
+    :Return:
+        generator of tuple(url, str page body)
+    """
+    logging.info('Requesting pages %s', urls)
+    request = request_page
+    if timeouts or session:
+        request = partial(request_page, timeouts=timeouts, session=session)
+    if cache:
+        request = cache.wrap(request)
+    if archive:
+        request = archive.wrap(request)
+
+    if scheduler:
+        responses = scheduler.fetch(urls, request)
+    else:
+        responses = ((url, _request_page(request, url)) for url in urls)
+    if progress:
+        responses = progress.timed('fetch', responses)
+
+    for url, page in responses:
+        if progress:
+            progress.count('failures' if page is None else 'pages')
+            progress.emit('page', url=url, ok=page is not None)
+        if page is not None:
+            yield url, page.content
+
+
+def request_pages(urls, archive=None):
     """
     Function that returns list of pages content from the list of urls
     Ignores exceptions
 
     :Parameters:
         - `urls`: list of str
+        - `archive`: archive.PageArchive to record responses
     :Return:
         generator of str that contains page body
     """
-    logging.info('Requesting pages %s', urls)
-    for url in urls:
+    for url, content in fetch_pages(urls, archive=archive):
+        yield content
+
+
+def normalize_links(url, hrefs):
+    """
+    Resolves hrefs of the page against its url
+    Drops links that are not http(s) or have no host
+
+    :Parameters:
+        - `url`: str url of the page
+        - `hrefs`: list of str
+    :Return:
+        generator of str absolute urls
+    """
+    for href in hrefs:
+        href = href.strip()
+        if not href.startswith(('http://', 'https://')):
+            href = urljoin(url, href)
+
         try:
-            page = request_page(url)
-            yield page.content
-        except RetryException as err:
-            logging.exception('Failed to retrieve page: %s', url)
-            print('Wrong url %s' % url)
+            parts = urlsplit(href)
+            port = parts.port
+        except ValueError:
+            continue
+
+        if parts.scheme not in DEFAULT_PORTS or not parts.hostname:
+            continue
+
+        netloc = parts.hostname
+        if ':' in netloc:
+            netloc = '[%s]' % netloc
+        if port and port != DEFAULT_PORTS[parts.scheme]:
+            netloc = '%s:%s' % (netloc, port)
+
+        yield urlunsplit((parts.scheme, netloc, parts.path or '/',
+                          parts.query, ''))
 
 
 def list_of_links_from_contents(contents, urls=None, parser=''):
@@ -160,21 +349,41 @@ def list_of_links_from_contents(contents, urls=None, parser=''):
                 yield url, link
 
 
-def data_from_urls(urls):
+def data_from_urls(urls, workers=None, scheduler=None, cache=None,
+                   memo=None, timeouts=None, progress=None, archive=None,
+                   replay=None, pool=None, session=None, resolver=None):
     """
     :Parameters:
         - urls: list of str
+        - workers: int number of parsing processes
+        - scheduler: scheduler.HostScheduler
+        - cache: http_cache.ResponseCache
+        - memo: link_memo.LinkMemo
+        - timeouts: timeouts.HostTimeouts
+        - progress: progress.Progress
+        - archive: archive.PageArchive to record fetched pages
+        - replay: archive.PageArchive to read pages from instead of
+          fetching them
+        - pool: multiprocessing.Pool shared by jobs, see parse_pool
+        - session: requests.Session to keep connections to hosts alive
+        - resolver: Resolver to reuse ips of domains
 
     :Return:
         generator of (url, (link, domain, ip))
     """
-    contents = request_pages(urls)
-
-    for url, link in list_of_links_from_contents(contents, urls):
-        logging.info('Retrieving url %s', link)
-        result = get_url_host_ip(link)
-        if result:
-            yield url, result
+    if replay:
+        pages = replay.pages(urls)
+    else:
+        pages = fetch_pages(urls, scheduler, cache, timeouts, progress,
+                            archive, session)
+
+    for url, hrefs in extract_links(pages, workers=workers, memo=memo,
+                                    pool=pool):
+        for link in normalize_links(url, hrefs):
+            logging.info('Retrieving url %s', link)
+            result = get_url_host_ip(link, resolver)
+            if result:
+                yield url, result
 
 
 def main():
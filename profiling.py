@@ -0,0 +1,206 @@
+"""
+Module for profiling crawl jobs on demand
+
+Profiler is armed for the next N jobs, when it is not armed
+jobs are called directly
+"""
+
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+
+from collections import Counter
+from StringIO import StringIO
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+MODES = ('cprofile', 'sample')
+SAMPLE_INTERVAL = 0.005
+TOP_FUNCTIONS = 50
+TOP_ALLOCATIONS = 25
+
+
+class Sampler(object):
+    """
+    Sampling profiler that records stacks of one thread
+    """
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        """
+        :Parameters:
+            - `thread_id`: int id of the thread to sample
+            - `interval`: float seconds between samples
+        """
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.running = False
+        self.thread = threading.Thread(target=self._sample)
+        self.thread.daemon = True
+
+    def _sample(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%s' % (os.path.basename(code.co_filename),
+                                        code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def dump(self, path):
+        """
+        Writes collapsed stacks, that can be turned into flame graph
+        :Parameters:
+            - `path`: str
+        """
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('%s %s\n' % (stack, count))
+
+
+class Profiler(object):
+    """
+    Controls profiling of the next jobs
+    """
+
+    def __init__(self, directory):
+        """
+        :Parameters:
+            - `directory`: str where profiles are written
+        """
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.remaining = 0
+        self.options = {}
+        self.counter = 0
+
+    def arm(self, jobs=1, mode='cprofile', trace_memory=False):
+        """
+        :Parameters:
+            - `jobs`: int number of next jobs to profile
+            - `mode`: str one of MODES
+            - `trace_memory`: bool take tracemalloc snapshots
+        """
+        if mode not in MODES:
+            raise ValueError('Unknown profiling mode %s' % mode)
+        with self.lock:
+            self.remaining = jobs
+            self.options = dict(mode=mode, trace_memory=trace_memory)
+
+    def run(self, func, *args, **kwargs):
+        """
+        Calls func, profiles it if profiler is armed
+        """
+        if not self.remaining:
+            return func(*args, **kwargs)
+
+        with self.lock:
+            if not self.remaining:
+                options = None
+            else:
+                self.remaining -= 1
+                options = self.options
+        if options is None:
+            return func(*args, **kwargs)
+        return self.profile(options, func, *args, **kwargs)
+
+    def profile(self, options, func, *args, **kwargs):
+        """
+        Calls func under profiler
+        :Parameters:
+            - `options`: dict with mode and trace_memory
+            - `func`: callable
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        with self.lock:
+            self.counter += 1
+            name = 'job-%s-%s' % (time.strftime('%Y%m%d-%H%M%S'),
+                                  self.counter)
+        path = os.path.join(self.directory, name)
+
+        trace_memory = options.get('trace_memory')
+        if trace_memory and tracemalloc is None:
+            logging.warning('tracemalloc is not available')
+            trace_memory = False
+        if trace_memory:
+            tracemalloc.start()
+
+        mode = options.get('mode', 'cprofile')
+        if mode == 'sample':
+            profiler = Sampler(threading.current_thread().ident)
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if mode == 'sample':
+                profiler.stop()
+                profiler.dump(path + '.stacks')
+            else:
+                profiler.disable()
+                profiler.dump_stats(path + '.prof')
+                self._write_stats(profiler, path + '.txt')
+
+            if trace_memory:
+                self._write_allocations(tracemalloc.take_snapshot(),
+                                        path + '.alloc.txt')
+                tracemalloc.stop()
+            logging.info('Profile of the job is written to %s', path)
+
+    @staticmethod
+    def _write_stats(profiler, path):
+        stream = StringIO()
+        stats = pstats.Stats(profiler, stream=stream)
+        stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+        with open(path, 'w') as f:
+            f.write(stream.getvalue())
+
+    @staticmethod
+    def _write_allocations(snapshot, path):
+        with open(path, 'w') as f:
+            for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+                f.write('%s\n' % stat)
+
+    def profiles(self):
+        """
+        :Return:
+            list of str names of written profiles
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(os.listdir(self.directory))
+
+    def read(self, name):
+        """
+        :Parameters:
+            - `name`: str name of the profile
+        :Return:
+            str content of the profile or None if there is no such profile
+        """
+        if name not in self.profiles():
+            return None
+        with open(os.path.join(self.directory, name), 'rb') as f:
+            return f.read()
@@ -0,0 +1,152 @@
+"""
+Module for reporting progress of the crawl job
+
+Events are put into the bounded queue without waiting, when the reader
+is slow they are dropped instead of stalling the crawl. Every event
+carries the running totals, so dropped events lose no information
+Time is accounted to stages exclusively: time of the nested stage is not
+counted in the stage that pulls from it. Stages are nested per thread,
+so stage advanced by another thread is not nested in stages of this one
+"""
+
+import threading
+import time
+
+from collections import Counter
+from Queue import Empty, Full, Queue
+
+QUEUE_SIZE = 1000
+TOTALS = ('pages', 'failures', 'links')
+
+
+class Progress(object):
+    """
+    Counters, stage timings and events of one job
+    """
+
+    def __init__(self, size=QUEUE_SIZE):
+        """
+        :Parameters:
+            - `size`: int maximal number of pending events
+        """
+        self.queue = Queue(size)
+        self.counters = Counter()
+        self.seconds = Counter()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.dropped = 0
+        self.closed = False
+
+    def emit(self, event, **fields):
+        """
+        Queues event with the running totals, drops it if queue is full
+        :Parameters:
+            - `event`: str type of the event
+        """
+        if self.closed:
+            return
+        with self.lock:
+            fields.update((name, self.counters[name]) for name in TOTALS)
+        fields['event'] = event
+        try:
+            self.queue.put_nowait(fields)
+        except Full:
+            with self.lock:
+                self.dropped += 1
+
+    def count(self, name, value=1):
+        """
+        :Parameters:
+            - `name`: str name of the counter
+            - `value`: int
+        """
+        with self.lock:
+            self.counters[name] += value
+
+    def _stack(self):
+        """
+        :Return:
+            list of time of nested stages of the current thread
+        """
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def _enter(self):
+        self._stack().append(0)
+        return time.time()
+
+    def _leave(self, name, start):
+        elapsed = time.time() - start
+        stack = self._stack()
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        with self.lock:
+            self.seconds[name] += elapsed - nested
+
+    def timed(self, name, iterable):
+        """
+        Accounts time of producing items of iterable to the stage
+        :Parameters:
+            - `name`: str name of the stage
+            - `iterable`: iterable
+        :Return:
+            generator of items of iterable
+        """
+        iterator = iter(iterable)
+        while True:
+            start = self._enter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._leave(name, start)
+            yield item
+
+    def call(self, name, func, *args, **kwargs):
+        """
+        Calls func accounting its time to the stage
+        :Parameters:
+            - `name`: str name of the stage
+            - `func`: callable
+        """
+        start = self._enter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._leave(name, start)
+
+    def next_event(self, timeout=0.5):
+        """
+        :Parameters:
+            - `timeout`: float seconds to wait for the next event
+        :Return:
+            event dict or None if there was no event
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def close(self):
+        """
+        Stops queueing events, e.g. when the reader is gone
+        """
+        self.closed = True
+
+    def summary(self):
+        """
+        :Return:
+            dict with totals, seconds per stage and dropped events
+        """
+        with self.lock:
+            summary = dict((name, self.counters[name]) for name in TOTALS)
+            summary['stages'] = dict(self.seconds)
+        summary['event'] = 'summary'
+        summary['seconds'] = time.time() - self.started
+        summary['dropped_events'] = self.dropped
+        return summary
@@ -0,0 +1,100 @@
+"""
+Module for compact representation of parsed links
+"""
+
+import socket
+import struct
+
+URL_BITS = 32
+IP_BITS = 32
+
+
+def ip_to_int(ip):
+    """
+    :Parameters:
+        - `ip`: str dotted-quad ip address
+    :Return:
+        int packed ip address, 0 if ip is not valid
+    """
+    try:
+        return struct.unpack('!I', socket.inet_aton(ip))[0]
+    except (socket.error, TypeError):
+        return 0
+
+
+def int_to_ip(ip):
+    """
+    :Parameters:
+        - `ip`: int packed ip address
+    :Return:
+        str dotted-quad ip address
+    """
+    return socket.inet_ntoa(struct.pack('!I', ip))
+
+
+class LinkBatch(object):
+    """
+    Counter of (domain, ip, url_id)
+
+    Domains are stored once per batch and every key is packed
+    into single int instead of tuple of strings
+    """
+
+    __slots__ = ('domains', 'domain_ids', 'counts')
+
+    def __init__(self):
+        self.domains = []
+        self.domain_ids = {}
+        self.counts = {}
+
+    def add(self, domain, ip, url_id, counter=1):
+        """
+        :Parameters:
+            - `domain`: str
+            - `ip`: int packed ip address
+            - `url_id`: int
+            - `counter`: int
+        """
+        domain_id = self.domain_ids.get(domain)
+        if domain_id is None:
+            domain_id = self.domain_ids[domain] = len(self.domains)
+            self.domains.append(domain)
+
+        key = (domain_id << (IP_BITS + URL_BITS)) | (ip << URL_BITS) | url_id
+        self.counts[key] = self.counts.get(key, 0) + counter
+
+    def extend(self, batch):
+        """
+        :Parameters:
+            - `batch`: LinkBatch
+        """
+        for domain, ip, url_id, counter in batch:
+            self.add(domain, ip, url_id, counter)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __iter__(self):
+        """
+        :Return:
+            generator of tuple(domain, ip, url_id, counter)
+        """
+        url_mask = (1 << URL_BITS) - 1
+        ip_mask = (1 << IP_BITS) - 1
+        for key, counter in self.counts.iteritems():
+            yield (self.domains[key >> (IP_BITS + URL_BITS)],
+                   (key >> URL_BITS) & ip_mask, key & url_mask, counter)
+
+
+def batch_from(lst, url_ids):
+    """
+    :Parameters:
+        - `lst`: list of tuple(url, HostingInfo)
+        - `url_ids`: dict[url, url_id]
+    :Return:
+        LinkBatch
+    """
+    batch = LinkBatch()
+    for url, host_info in lst:
+        batch.add(host_info.domain, ip_to_int(host_info.ip), url_ids[url])
+    return batch
@@ -0,0 +1,265 @@
+"""
+Module for fetching pages concurrently without hammering one host
+
+Every host has its own queue, token bucket and concurrency limit
+Workers take urls from host queues in round-robin order, so slow hosts
+never block fast ones. Concurrency of the host grows while it answers
+fast and shrinks on errors and slow answers
+"""
+
+import logging
+import threading
+import time
+
+from collections import deque, OrderedDict
+from Queue import Queue
+from urlparse import urlparse
+
+CONCURRENCY = 16
+HOST_RATE = 5.0
+HOST_BURST = 5
+HOST_LIMIT = 2
+MAX_HOST_LIMIT = 8
+SLOW_LATENCY = 2.0
+EWMA_WEIGHT = 0.3
+
+
+class TokenBucket(object):
+    """
+    Limits rate of requests
+    """
+
+    def __init__(self, rate, burst):
+        """
+        :Parameters:
+            - `rate`: float tokens per second
+            - `burst`: int maximum number of tokens
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+
+    def take(self, now):
+        """
+        :Parameters:
+            - `now`: float current time
+        :Return:
+            float 0 if token was taken, else seconds to wait for the token
+        """
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class HostState(object):
+    """
+    Queue and statistics of one host
+    """
+
+    def __init__(self, rate, burst, limit):
+        self.queue = deque()
+        self.bucket = TokenBucket(rate, burst)
+        self.limit = limit
+        self.active = 0
+        self.successes = 0
+        self.requests = 0
+        self.errors = 0
+        self.latency = None
+
+    def stats(self):
+        """
+        :Return:
+            dict
+        """
+        return {
+            'pending': len(self.queue),
+            'active': self.active,
+            'limit': self.limit,
+            'requests': self.requests,
+            'errors': self.errors,
+            'latency_ms': self.latency and self.latency * 1000,
+        }
+
+
+class HostScheduler(object):
+    """
+    Host aware scheduler of requests
+    """
+
+    def __init__(self, concurrency=CONCURRENCY, host_rate=HOST_RATE,
+                 host_burst=HOST_BURST, host_limit=HOST_LIMIT,
+                 max_host_limit=MAX_HOST_LIMIT, slow_latency=SLOW_LATENCY):
+        """
+        :Parameters:
+            - `concurrency`: int global limit of requests in flight
+            - `host_rate`: float requests per second to one host
+            - `host_burst`: int size of the host token bucket
+            - `host_limit`: int initial limit of requests to one host
+            - `max_host_limit`: int maximal limit of requests to one host
+            - `slow_latency`: float seconds, slower answers shrink limit
+        """
+        self.concurrency = concurrency
+        self.host_rate = host_rate
+        self.host_burst = host_burst
+        self.host_limit = host_limit
+        self.max_host_limit = max_host_limit
+        self.slow_latency = slow_latency
+
+        self.hosts = OrderedDict()
+        self.ring = deque()
+        self.condition = threading.Condition()
+        self.pending = 0
+        self.active = 0
+        self.completed = 0
+        self.errors = 0
+        self.stopped = False
+
+    def _add(self, url):
+        host = urlparse(url).netloc.lower()
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = HostState(
+                self.host_rate, self.host_burst, self.host_limit)
+        if not state.queue:
+            self.ring.append(host)
+        state.queue.append(url)
+        self.pending += 1
+
+    def _next(self):
+        """
+        Round-robin over hosts with pending urls
+        Must be called with condition acquired
+        :Return:
+            tuple(host, url, None) or tuple(None, None, seconds to wait)
+        """
+        now = time.time()
+        wait = None
+        for _ in range(len(self.ring)):
+            host = self.ring[0]
+            self.ring.rotate(-1)
+            state = self.hosts[host]
+            if state.active >= state.limit:
+                continue
+            delay = state.bucket.take(now)
+            if delay:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+
+            url = state.queue.popleft()
+            if not state.queue:
+                self.ring.remove(host)
+            state.active += 1
+            self.active += 1
+            self.pending -= 1
+            return host, url, None
+        return None, None, wait
+
+    def _done(self, host, latency, failed):
+        """
+        Adapts concurrency of the host
+        Must be called with condition acquired
+        """
+        state = self.hosts[host]
+        state.active -= 1
+        state.requests += 1
+        self.active -= 1
+        self.completed += 1
+
+        if state.latency is None:
+            state.latency = latency
+        else:
+            state.latency += EWMA_WEIGHT * (latency - state.latency)
+
+        if failed:
+            state.errors += 1
+            self.errors += 1
+            state.successes = 0
+            state.limit = max(1, state.limit // 2)
+        elif state.latency > self.slow_latency:
+            state.successes = 0
+            state.limit = max(1, state.limit - 1)
+        else:
+            state.successes += 1
+            if state.successes >= state.limit:
+                state.successes = 0
+                state.limit = min(self.max_host_limit, state.limit + 1)
+
+        self.condition.notify_all()
+
+    def _work(self, request, results):
+        while True:
+            with self.condition:
+                while True:
+                    if self.stopped or not self.pending:
+                        return
+                    host, url, wait = self._next()
+                    if host:
+                        break
+                    self.condition.wait(wait)
+
+            start = time.time()
+            response = None
+            try:
+                response = request(url)
+            except Exception:
+                logging.exception('Failed to retrieve page: %s', url)
+
+            with self.condition:
+                self._done(host, time.time() - start, response is None)
+            results.put((url, response))
+
+    def fetch(self, urls, request):
+        """
+        :Parameters:
+            - `urls`: iterable of str
+            - `request`: callable that takes url and returns response
+        :Return:
+            generator of tuple(url, response or None if request failed)
+            in order of completion
+        """
+        results = Queue()
+        with self.condition:
+            self.stopped = False
+            total = 0
+            for url in urls:
+                self._add(url)
+                total += 1
+
+        workers = [threading.Thread(target=self._work,
+                                    args=(request, results))
+                   for _ in range(min(self.concurrency, total))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        try:
+            for _ in range(total):
+                yield results.get()
+        finally:
+            with self.condition:
+                self.stopped = True
+                for state in self.hosts.values():
+                    state.queue.clear()
+                self.ring.clear()
+                self.pending = 0
+                self.condition.notify_all()
+
+    def stats(self):
+        """
+        :Return:
+            dict with global and per host stats
+        """
+        with self.condition:
+            return {
+                'pending': self.pending,
+                'active': self.active,
+                'completed': self.completed,
+                'errors': self.errors,
+                'hosts': dict((host, state.stats())
+                              for host, state in self.hosts.items()),
+            }
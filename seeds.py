@@ -0,0 +1,104 @@
+"""
+Module for reading seed urls as a stream
+
+Seeds are read from a file, gzip file or stdin line by line and split
+into windows of bounded size, so memory does not depend on the number
+of seeds. Checkpoint remembers how many lines were processed, so the
+interrupted run is resumed after the last finished window
+"""
+
+import gzip
+import json
+import logging
+import os
+import sys
+
+from itertools import islice
+
+WINDOW = 1000
+
+
+def open_seeds(path):
+    """
+    :Parameters:
+        - `path`: str path to the file, '-' for stdin, .gz files are
+          decompressed
+    :Return:
+        file
+    """
+    if path == '-':
+        return sys.stdin
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def windows(f, size=WINDOW, skip=0):
+    """
+    :Parameters:
+        - `f`: file with one url per line, empty lines and lines starting
+          with # are ignored
+        - `size`: int number of lines in the window
+        - `skip`: int number of lines processed before
+    :Return:
+        generator of tuple(number of lines read so far, list of urls)
+    """
+    lines = iter(f)
+    if skip:
+        skipped = sum(1 for _ in islice(lines, skip))
+        if skipped < skip:
+            logging.warning('Seeds end before the checkpoint at line %s',
+                            skip)
+
+    position = skip
+    while True:
+        chunk = list(islice(lines, size))
+        if not chunk:
+            return
+        position += len(chunk)
+        urls = [line.strip() for line in chunk]
+        yield position, [url for url in urls
+                         if url and not url.startswith('#')]
+
+
+class Checkpoint(object):
+    """
+    Number of processed lines of the seed source persisted in json file
+    """
+
+    def __init__(self, path, source):
+        """
+        :Parameters:
+            - `path`: str path to the checkpoint file
+            - `source`: str path of the seeds
+        """
+        self.path = path
+        self.source = source
+        self.lines = 0
+
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if state.get('source') == source:
+                self.lines = state['lines']
+            else:
+                logging.warning('Checkpoint %s is for %s, starting from '
+                                'the beginning', path, state.get('source'))
+
+    def save(self, lines):
+        """
+        :Parameters:
+            - `lines`: int number of processed lines
+        """
+        self.lines = lines
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'source': self.source, 'lines': lines}, f)
+        os.rename(tmp, self.path)
+
+    def clear(self):
+        """
+        Removes the checkpoint of the finished run
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -4,14 +4,39 @@ Supports:
 adding new url to parse links
 fetching list of parsed urls
 fetching list of parsed links and count of their occurenses
+streaming progress of the crawl as newline delimited json
+Jobs are admitted by the load of the host, see admission module
+Pages of the job are fetched concurrently with concurrency field
+or FETCH_CONCURRENCY, see scheduler module
 """
+import base64
 import socket
 import logging
 import json
 
 from threading import Thread
 
+import db_api
 import insert_db
+from admission import Admission
+from delta import FingerprintStore
+from link_memo import LinkMemo
+from local import (admission_settings, fingerprint_path, hedge_requests,
+                   memo_path, profile_dir, settings, spool_dir)
+from parse_pool import make_pool
+from profiling import MODES, Profiler
+from progress import Progress
+from spool import Spool, replay
+from timeouts import HostTimeouts
+
+cache = insert_db.get_cache()
+memo = LinkMemo(memo_path or None)
+profiler = Profiler(profile_dir)
+timeouts = HostTimeouts(hedge=hedge_requests)
+admission = Admission(**admission_settings)
+fingerprints = fingerprint_path and FingerprintStore(fingerprint_path)
+spool = spool_dir and Spool(spool_dir)
+parse_pool = None
 
 
 def create_server_socket(host='127.0.0.1', port=8000):
@@ -35,6 +60,141 @@ def create_server_socket(host='127.0.0.1', port=8000):
     return serversocket
 
 
+def arm_profiler(data):
+    """
+    Profiles next jobs
+    :Parameters:
+         - `data`: dict with jobs, mode and tracemalloc
+    :Return:
+        dict
+    """
+    jobs = int(data.get('jobs', 1))
+    profiler.arm(jobs, data.get('mode', 'cprofile'),
+                 bool(data.get('tracemalloc')))
+    return {'armed': jobs}
+
+
+def list_profiles(data):
+    """
+    :Return:
+        dict with names of written profiles
+    """
+    return {'profiles': profiler.profiles()}
+
+
+def fetch_profile(data):
+    """
+    :Parameters:
+         - `data`: dict with name of the profile
+    :Return:
+        dict with base64 encoded profile
+    """
+    content = profiler.read(data.get('name'))
+    if content is None:
+        return {'error': 'No such profile'}
+    return {'name': data['name'], 'data': base64.b64encode(content)}
+
+
+def timeout_stats(data):
+    """
+    :Return:
+        dict with adaptive timeouts of hosts
+    """
+    return timeouts.stats()
+
+
+def admission_stats(data):
+    """
+    :Return:
+        dict with load of the host and admission decisions
+    """
+    return admission.stats()
+
+
+def replay_spool(data):
+    """
+    Loads spooled links into db
+    :Return:
+        dict with replay stats
+    """
+    if not spool:
+        return {'error': 'Spool is not configured'}
+    spool.seal()
+    stats = replay(spool_dir, db_api.DBAPI(**settings))
+    if stats is None:
+        return {'error': 'Spool is replayed by another process'}
+    return stats
+
+
+COMMANDS = {
+    'admission': admission_stats,
+    'replay_spool': replay_spool,
+    'timeouts': timeout_stats,
+    'profile': arm_profiler,
+    'profiles': list_profiles,
+    'profile_fetch': fetch_profile,
+}
+
+
+def handle_command(data, connection):
+    """
+    Function for handling admin commands
+    :Parameters:
+         - `data`: dict
+         - `connection`: socket.connection
+    """
+    command = COMMANDS.get(data['command'])
+    if not command:
+        connection.sendall('Unknown command')
+        return
+
+    try:
+        response = command(data)
+    except ValueError as err:
+        response = {'error': str(err)}
+    connection.sendall(json.dumps(response))
+
+
+def stream(connection, progress, target, args, kwargs):
+    """
+    Runs the job in background and sends its progress as ndjson,
+    the last line is the summary of the job
+    The job never waits for the client, events the client is too slow
+    to read are dropped
+    :Parameters:
+         - `connection`: socket.connection
+         - `progress`: progress.Progress passed to the job
+         - `target`: callable that runs the job
+    """
+    errors = []
+
+    def job():
+        try:
+            target(*args, **kwargs)
+        except Exception as err:
+            logging.exception('Job failed')
+            errors.append(str(err))
+
+    thread = Thread(target=job)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        connection.sendall(json.dumps({'event': 'accepted'}) + '\n')
+        while thread.is_alive() or not progress.queue.empty():
+            event = progress.next_event()
+            if event:
+                connection.sendall(json.dumps(event) + '\n')
+
+        summary = progress.summary()
+        if errors:
+            summary['error'] = errors[0]
+        connection.sendall(json.dumps(summary) + '\n')
+    except socket.error:
+        logging.warning('Client is gone, job continues without progress')
+        progress.close()
+
+
 def handler(data, connection):
     """
     Function for handling requests
@@ -48,13 +208,42 @@ def handler(data, connection):
         connection.sendall('Send valid data')
         return
 
+    if 'command' in data:
+        handle_command(data, connection)
+        return
+
     try:
         data['urls']
     except KeyError:
         connection.sendall('Include urls in your json data')
         return
 
-    thread = Thread(target=insert_db.fetch_urls, args=[data.get('urls', [])])
+    args = [insert_db.fetch_urls, data.get('urls', [])]
+    kwargs = {'cache': cache, 'memo': memo, 'timeouts': timeouts,
+              'depth': int(data.get('depth', 0)),
+              'fingerprints': fingerprints or None, 'spool': spool or None,
+              'parse_pool': parse_pool,
+              'scheduler': insert_db.get_scheduler(
+                  data.get('concurrency') and int(data['concurrency']))}
+    target = profiler.run
+    if data.get('profile'):
+        mode = data['profile'] if data['profile'] in MODES else 'cprofile'
+        options = {'mode': mode, 'trace_memory': data.get('tracemalloc')}
+        target, args = profiler.profile, [options] + args
+
+    if not admission.acquire():
+        connection.sendall(json.dumps({
+            'accepted': False, 'retry_after': admission.retry_after()}))
+        return
+    kwargs['parse_workers'] = admission.workers()
+    args = [target] + args
+
+    if data.get('stream'):
+        kwargs['progress'] = Progress()
+        stream(connection, kwargs['progress'], admission.run, args, kwargs)
+        return
+
+    thread = Thread(target=admission.run, args=args, kwargs=kwargs)
     thread.run()
     connection.sendall(json.dumps({'accepted': True}))
 
@@ -88,17 +277,24 @@ def client_thread(connection, client_address, handler):
 
 
 def main():
+    global parse_pool
     port = int(raw_input('Please enter port number(int)'))  # let it fail
     serversocket = create_server_socket(port=port)
     if not serversocket:
         return
+    # workers are forked before any thread is started
+    parse_pool = make_pool()
+    admission.start()
     try:
         while True:
             connection, address = serversocket.accept()
             ct = client_thread(connection, address, handler)
-            ct.run()
+            ct.daemon = True
+            ct.start()
     finally:
         serversocket.close()
+        if parse_pool:
+            parse_pool.terminate()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,258 @@
+"""
+Module for spooling links to local disk while db is slow or unavailable
+
+Spool is a directory of segment files. Every line of the segment is
+crc32 of the record followed by the record as json: unique id of the
+batch and its rows. The segment being written ends with .open, when it
+is sealed it is compressed with gzip. Segments left open by dead
+processes are sealed by the replayer
+
+The replayer loads sealed segments into db with LOAD DATA and deletes
+them. Ids of applied batches are stored in db in the same transaction
+as the rows, so segment that is replayed again after crash is skipped
+"""
+
+import argparse
+import errno
+import fcntl
+import glob
+import gzip
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+import zlib
+
+import db_api
+from db_api import BULK_THRESHOLD
+from local import settings, spool_dir
+
+SEGMENT_BYTES = 64 * 1024 * 1024
+OPEN_SUFFIX = '.open'
+SEALED_SUFFIX = '.ndjson.gz'
+LOCK_FILE = 'replay.lock'
+
+
+def encode(record):
+    """
+    :Parameters:
+        - `record`: dict
+    :Return:
+        str line with checksum
+    """
+    data = json.dumps(record, separators=(',', ':'))
+    return '%08x %s\n' % (zlib.crc32(data) & 0xffffffff, data)
+
+
+def decode(line):
+    """
+    :Parameters:
+        - `line`: str
+    :Return:
+        dict record or None if line is corrupted
+    """
+    checksum, _, data = line.rstrip('\n').partition(' ')
+    try:
+        if int(checksum, 16) != zlib.crc32(data) & 0xffffffff:
+            return None
+        return json.loads(data)
+    except ValueError:
+        return None
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+
+class Spool(object):
+    """
+    Append-only spool of link batches
+    """
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES):
+        """
+        :Parameters:
+            - `directory`: str path to the spool directory
+            - `segment_bytes`: int size after which segment is sealed
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        self.segment = None
+        self.writer = None
+        self.number = 0
+        self.counters = {'batches': 0, 'rows': 0, 'segments': 0}
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def append(self, batch):
+        """
+        :Parameters:
+            - `batch`: iterable of tuple(domain, ip, url_id, counter)
+        :Return:
+            str id of the spooled batch
+        """
+        rows = [list(row) for row in batch]
+        batch_id = uuid.uuid4().hex
+        line = encode({'id': batch_id, 'rows': rows})
+        with self.lock:
+            if self.writer is None:
+                self._open()
+            self.writer.write(line)
+            self.writer.flush()
+            self.counters['batches'] += 1
+            self.counters['rows'] += len(rows)
+            if self.writer.tell() >= self.segment_bytes:
+                self._seal()
+        return batch_id
+
+    def _open(self):
+        self.number += 1
+        name = 'segment-%013d-%s-%s' % (int(time.time() * 1000),
+                                        os.getpid(), self.number)
+        self.segment = os.path.join(self.directory, name)
+        self.writer = open(self.segment + OPEN_SUFFIX, 'ab')
+        self.counters['segments'] += 1
+
+    def _seal(self):
+        self.writer.close()
+        self.writer = None
+        seal(self.segment + OPEN_SUFFIX)
+
+    def seal(self):
+        """
+        Seals the current segment, so it can be replayed
+        """
+        with self.lock:
+            if self.writer is not None:
+                self._seal()
+
+    def stats(self):
+        """
+        :Return:
+            dict
+        """
+        with self.lock:
+            return dict(self.counters)
+
+
+def seal(path):
+    """
+    Compresses the open segment
+    :Parameters:
+        - `path`: str path to the open segment
+    :Return:
+        str path to the sealed segment
+    """
+    sealed = path[:-len(OPEN_SUFFIX)] + SEALED_SUFFIX
+    tmp = sealed + '.tmp'
+    with open(path, 'rb') as src:
+        with gzip.open(tmp, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+    os.rename(tmp, sealed)
+    os.remove(path)
+    return sealed
+
+
+def sealed_segments(directory):
+    """
+    Seals segments of dead processes
+    :Parameters:
+        - `directory`: str path to the spool directory
+    :Return:
+        list of str paths to sealed segments in order of writing
+    """
+    for path in glob.glob(os.path.join(directory, '*' + OPEN_SUFFIX)):
+        pid = int(os.path.basename(path).split('-')[2])
+        if not _pid_alive(pid):
+            logging.warning('Sealing segment %s of dead process', path)
+            seal(path)
+    return sorted(glob.glob(os.path.join(directory, '*' + SEALED_SUFFIX)))
+
+
+def read_segment(path):
+    """
+    :Parameters:
+        - `path`: str path to the sealed segment
+    :Return:
+        generator of record dicts, corrupted records are skipped
+    """
+    with gzip.open(path, 'rb') as f:
+        for number, line in enumerate(f, 1):
+            record = decode(line)
+            if record is None:
+                logging.error('Corrupted record %s of segment %s',
+                              number, path)
+                continue
+            yield record
+
+
+def replay(directory, db, batch_rows=BULK_THRESHOLD):
+    """
+    Loads sealed segments into db and removes them
+    Only one replayer runs at a time, the others return at once
+    :Parameters:
+        - `directory`: str path to the spool directory
+        - `db`: db_api.DBAPI
+        - `batch_rows`: int number of rows loaded with one transaction
+    :Return:
+        dict stats or None if another replayer is running
+    """
+    stats = {'segments': 0, 'batches': 0, 'skipped': 0, 'rows': 0}
+    with open(os.path.join(directory, LOCK_FILE), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            logging.info('Spool %s is replayed by another process',
+                         directory)
+            return None
+
+        for path in sealed_segments(directory):
+            records, rows = [], 0
+            for record in read_segment(path):
+                records.append((record['id'], record['rows']))
+                rows += len(record['rows'])
+                if rows >= batch_rows:
+                    _apply(db, records, stats)
+                    records, rows = [], 0
+            if records:
+                _apply(db, records, stats)
+
+            os.remove(path)
+            stats['segments'] += 1
+            logging.info('Replayed segment %s', path)
+    return stats
+
+
+def _apply(db, records, stats):
+    applied = db.insert_spooled(records)
+    stats['batches'] += applied
+    stats['skipped'] += len(records) - applied
+    stats['rows'] += sum(len(rows) for _, rows in records)
+
+
+def main():
+    """
+    Replays the spool into db
+    """
+    parser = argparse.ArgumentParser(description='Spool replayer.')
+    parser.add_argument('--directory', default=spool_dir)
+    parser.add_argument('--batch-rows', type=int, default=BULK_THRESHOLD,
+                        dest='batch_rows')
+    args = parser.parse_args()
+    if not args.directory:
+        parser.error('Spool directory is not configured, set SPOOL_DIR')
+
+    print(replay(args.directory, db_api.DBAPI(**settings), args.batch_rows))
+
+
+if __name__ == '__main__':
+    main()
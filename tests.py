@@ -2,17 +2,52 @@
 Module for testing functionality of the parsing module
 """
 
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import time
 import unittest
 
 from collections import defaultdict
-from socket import error
+from multiprocessing import Process
+from socket import create_connection, error, socketpair
+from threading import Thread
 
 from connector import insert
+from StringIO import StringIO
+
+import requests
+
+from pymysql import InternalError, OperationalError
+
+from admission import Admission
+from archive import PageArchive, replay
+from coordinator import Aggregator, HashRing, partition, send
+from db_api import DBAPI, DBAPIException
+from delta import FingerprintStore, write_deltas
+from exporter import export
+from frontier import BloomFilter, Frontier, crawl
+from http_cache import CachedResponse, ResponseCache
+from insert_db import fetch_seeds, get_scheduler, main as insert_db_main
+from link_memo import LinkMemo
 from parsing import (get_url_host_ip, domain_from_url, get_ip_from_url,
-                     RETRY, request_page, RetryException,
-                     list_of_links_from_contents)
+                     RETRY, request_page, RetryException, HostingInfo,
+                     Resolver,
+                     list_of_links_from_contents, normalize_links)
+from parse_pool import WINDOW, batches, extract_links, make_pool
 from parsers import BeautifulSoupParser
 from patch import patch, MagicMock
+from profiling import Profiler
+from progress import Progress
+from records import LinkBatch, batch_from, int_to_ip, ip_to_int
+from scheduler import HostScheduler, TokenBucket
+from seeds import Checkpoint, open_seeds, windows
+from spool import Spool, read_segment, replay as replay_spool, sealed_segments
+from server import stream
+from timeouts import HostTimeouts
+from writer import DBWriter
 
 
 def fake_ip(ip):
@@ -92,6 +127,48 @@ class TestUrlParsing(unittest.TestCase):
 
         self.assertEqual(result, fake_ip(1))
 
+    def test_resolver_reuses_ips(self):
+        lookups = []
+
+        def lookup(domain):
+            lookups.append(domain)
+            return '1.1.1.1'
+
+        resolver = Resolver(ttl=60)
+        with patch('parsing.get_ip_from_url', lookup):
+            self.assertEqual(get_url_host_ip('http://vk.com/a', resolver).ip,
+                             '1.1.1.1')
+            self.assertEqual(resolver('vk.com'), '1.1.1.1')
+        self.assertEqual(lookups, ['vk.com'])
+
+
+class TestNormalizingLinks(unittest.TestCase):
+    """
+    Test resolving and filtering of hrefs
+    """
+
+    def test_relative_links_are_resolved(self):
+        result = list(normalize_links('http://vk.com/a/b', [
+            '/', 'c', '#top', '//youtube.com/x?y=1']))
+
+        self.assertEqual(result, ['http://vk.com/', 'http://vk.com/a/c',
+                                  'http://vk.com/a/b',
+                                  'http://youtube.com/x?y=1'])
+
+    def test_host_and_port_are_canonical(self):
+        result = list(normalize_links('http://vk.com', [
+            'HTTP://VK.com:80/a', 'https://vk.com:443', 'http://vk.com:8080']))
+
+        self.assertEqual(result, ['http://vk.com/a', 'https://vk.com/',
+                                  'http://vk.com:8080/'])
+
+    def test_not_http_links_are_dropped(self):
+        result = list(normalize_links('http://vk.com', [
+            'mailto:a@vk.com', 'javascript:void(0)', 'ftp://vk.com',
+            'http://vk.com:port']))
+
+        self.assertEqual(result, [])
+
 
 class TesBS4Parser(unittest.TestCase):
     """
@@ -147,6 +224,15 @@ class TestRequestingPages(unittest.TestCase):
         with self.assertRaises(RetryException):
             request_page(url)
 
+    def test_request_page_uses_session(self):
+        class Session(object):
+            def get(self, url, **kwargs):
+                return url
+
+        result = request_page('page', session=Session())
+
+        self.assertEqual(result, 'page')
+
 
 class TestFetchingLinks(unittest.TestCase):
     """
@@ -165,6 +251,1393 @@ class TestFetchingLinks(unittest.TestCase):
         self.assertEqual(len(result), 4)
 
 
+class TestParsePool(unittest.TestCase):
+    """
+    Test parsing pages in the pool of processes
+    """
+
+    def setUp(self):
+        self.pages = [('a', '<a href="vk.com"></a>'), ('b', ''),
+                      ('c', '<a href="/"></a><a href="youtube.com"></a>')]
+        self.expected = [('a', ['vk.com']), ('c', ['/', 'youtube.com'])]
+
+    def test_batches_skip_empty_pages(self):
+        result = list(batches(self.pages, batch_bytes=1))
+        self.assertEqual([[url for url, _ in batch] for batch in result],
+                         [['a'], ['c']])
+
+    def test_extract_links_in_process(self):
+        result = list(extract_links(self.pages, workers=1))
+        self.assertEqual(result, self.expected)
+
+    def test_extract_links_with_pool(self):
+        result = list(extract_links(self.pages, workers=2, min_pages=1))
+        self.assertEqual(result, self.expected)
+
+    def test_shared_pool_is_reused(self):
+        pool = make_pool(2)
+        try:
+            for _ in range(2):
+                result = list(extract_links(self.pages, workers=2,
+                                            min_pages=1, pool=pool))
+                self.assertEqual(result, self.expected)
+        finally:
+            pool.terminate()
+
+    def test_pages_are_not_read_ahead_of_parsing(self):
+        read = []
+
+        def pages():
+            for number in range(100):
+                read.append(number)
+                yield str(number), '<a href="vk.com"></a>'
+
+        result = extract_links(pages(), workers=2, batch_bytes=1,
+                               min_pages=1)
+        next(result)
+        self.assertLessEqual(len(read), 2 * WINDOW + 1)
+        self.assertEqual(len(list(result)), 99)
+
+
+class FakeDB(object):
+    """
+    Keeps inserted rows in memory
+    """
+
+    def __init__(self):
+        self.rows = []
+
+    def insert(self, data):
+        self.rows.extend(data)
+
+
+def fake_worker(number, address):
+    connection = create_connection(address)
+    send(connection, {'type': 'links', 'worker': number,
+                      'rows': [['a', 'vk.com', 16843009]]})
+    send(connection, {'type': 'done', 'worker': number, 'links': 1})
+    connection.close()
+
+
+class TestCoordinator(unittest.TestCase):
+    """
+    Test partitioning urls and aggregating results of workers
+    """
+
+    def test_same_domain_goes_to_same_worker(self):
+        shards = partition(['http://vk.com/a', 'http://www.vk.com/b',
+                            'http://youtube.com'], 4)
+        self.assertIn(['http://vk.com/a', 'http://www.vk.com/b'], shards)
+
+    def test_adding_node_moves_few_keys(self):
+        keys = ['domain%s.com' % i for i in range(1000)]
+        old, new = HashRing(range(4)), HashRing(range(5))
+        moved = sum(old.node(key) != new.node(key) for key in keys)
+        self.assertLess(moved, 350)
+
+    def test_aggregator_collects_results_of_workers(self):
+        db = FakeDB()
+        writer = DBWriter(db)
+        aggregator = Aggregator(writer, {'a': 7})
+        processes = [Process(target=fake_worker,
+                             args=(number, aggregator.address))
+                     for number in range(3)]
+        for process in processes:
+            process.start()
+        writer.start()
+
+        stats = aggregator.serve(processes)
+        aggregator.close()
+        writer.close()
+
+        self.assertEqual(stats['done'], 3)
+        self.assertEqual(stats['failed'], 0)
+        self.assertEqual(sum(counter for _, _, _, counter in db.rows), 3)
+        self.assertEqual(set(row[:3] for row in db.rows),
+                         set([('vk.com', 16843009, 7)]))
+
+    def test_aggregator_goes_on_after_lost_connection(self):
+        db = DBAPI('user', 'password', 'host', 'db')
+        db._connection = connection = MagicMock()
+        connection.close = MagicMock()
+        connection.cursor = FailingCursor('INSERT', OperationalError)
+        writer = DBWriter(db, group_rows=1)
+        aggregator = Aggregator(writer, {'a': 7})
+        message = {'type': 'links', 'worker': 0,
+                   'rows': [['a', 'vk.com', 16843009]]}
+
+        def get_connection(settings):
+            raise OperationalError()
+
+        with patch('db_api.get_connection', get_connection):
+            writer.start()
+            aggregator.handle(message)
+            aggregator.handle(message)
+            aggregator.close()
+            stats = writer.close()
+
+        self.assertEqual((stats['failed'], stats['commits']), (2, 0))
+        self.assertEqual(connection.close.call_count, 1)
+
+
+class TestHostScheduler(unittest.TestCase):
+    """
+    Test host aware scheduling of requests
+    """
+
+    def test_token_bucket_limits_rate(self):
+        bucket = TokenBucket(rate=1, burst=2)
+        now = bucket.updated
+
+        self.assertEqual(bucket.take(now), 0)
+        self.assertEqual(bucket.take(now), 0)
+        self.assertAlmostEqual(bucket.take(now), 1)
+        self.assertEqual(bucket.take(now + 1), 0)
+
+    def test_hosts_are_served_round_robin(self):
+        scheduler = HostScheduler(concurrency=1)
+        urls = ['http://a.com/1', 'http://a.com/2', 'http://b.com/1']
+
+        result = [url for url, _ in scheduler.fetch(urls, lambda url: url)]
+
+        self.assertEqual(result, ['http://a.com/1', 'http://b.com/1',
+                                  'http://a.com/2'])
+
+    def test_errors_shrink_host_limit(self):
+        def request(url):
+            raise Exception()
+
+        scheduler = HostScheduler(concurrency=1, host_limit=4)
+        result = list(scheduler.fetch(['http://a.com/1'], request))
+        stats = scheduler.stats()
+
+        self.assertEqual(result, [('http://a.com/1', None)])
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['hosts']['a.com']['limit'], 2)
+
+    def test_scheduler_follows_concurrency_setting(self):
+        self.assertIsNone(get_scheduler(1))
+        self.assertEqual(get_scheduler(4).concurrency, 4)
+        with patch('insert_db.fetch_concurrency', 0):
+            self.assertIsNone(get_scheduler())
+        with patch('insert_db.fetch_concurrency', 8):
+            self.assertEqual(get_scheduler().concurrency, 8)
+
+
+class TestHostTimeouts(unittest.TestCase):
+    """
+    Test adaptive timeouts and hedged requests
+    """
+
+    def test_timeout_follows_latency_within_bounds(self):
+        timeouts = HostTimeouts(default=3, min_timeout=0.5, max_timeout=5,
+                                factor=2, min_samples=2)
+
+        self.assertEqual(timeouts.timeout('a.com'), 3)
+        for latency in (0.1, 0.2, 1.0):
+            timeouts.record('a.com', latency)
+            timeouts.record('b.com', latency * 10)
+
+        self.assertEqual(timeouts.timeout('a.com'), 2)
+        self.assertEqual(timeouts.timeout('b.com'), 5)
+        timeouts.record('c.com', 0.01)
+        timeouts.record('c.com', 0.01)
+        self.assertEqual(timeouts.timeout('c.com'), 0.5)
+
+    def test_timed_out_request_raises_timeout(self):
+        def get(url, timeout=None, **kwargs):
+            raise requests.exceptions.Timeout()
+
+        timeouts = HostTimeouts(default=3, min_samples=1)
+        with patch('timeouts.requests.get', get):
+            with self.assertRaises(requests.exceptions.Timeout):
+                timeouts.get('http://a.com/')
+
+        self.assertEqual(timeouts.stats()['timeouts'], 1)
+        self.assertEqual(timeouts.timeout('a.com'), 3)
+
+    def test_single_stall_does_not_grow_timeout(self):
+        timeouts = HostTimeouts(min_timeout=0.1, factor=2, min_samples=2)
+        for latency in (0.1, 0.1, 0.1):
+            timeouts.record('a.com', latency)
+
+        timeouts.record('a.com', None)
+        self.assertEqual(timeouts.timeout('a.com'), 0.2)
+        timeouts.record('a.com', None)
+        timeouts.record('a.com', None)
+        self.assertEqual(timeouts.timeout('a.com'), 0.4)
+
+    def test_stalls_grow_timeout_of_slow_host(self):
+        timeouts = HostTimeouts(default=3, max_timeout=15, factor=2)
+        timeouts.record('a.com', 2.5)
+        for _ in range(3):
+            timeouts.record('a.com', None)
+
+        self.assertEqual(timeouts.timeout('a.com'), 6)
+        timeouts.record('a.com', 5)
+        self.assertEqual(timeouts.timeout('a.com'), 12)
+
+    def test_stalls_do_not_grow_timeout_of_dead_host(self):
+        timeouts = HostTimeouts(default=3, min_timeout=0.5, max_timeout=15,
+                                factor=2, min_samples=10)
+        for _ in range(10):
+            timeouts.record('a.com', None)
+            timeouts.record('b.com', 0.05)
+            timeouts.record('b.com', None)
+
+        self.assertEqual(timeouts.timeout('a.com'), 3)
+        self.assertEqual(timeouts.timeout('b.com'), 0.5)
+
+    def test_slow_request_is_hedged(self):
+        calls = []
+
+        def get(url, timeout=None, **kwargs):
+            calls.append(url)
+            if len(calls) == 1:
+                time.sleep(0.5)
+                return 'slow'
+            return 'fast'
+
+        timeouts = HostTimeouts(min_samples=1, hedge=True)
+        timeouts.record('a.com', 0.01)
+        with patch('timeouts.requests.get', get):
+            result = timeouts.get('http://a.com/')
+
+        self.assertEqual(result, 'fast')
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(timeouts.stats()['hedge_wins'], 1)
+
+
+class TestProgress(unittest.TestCase):
+    """
+    Test progress events and stage timings of the job
+    """
+
+    def test_nested_stage_time_is_exclusive(self):
+        progress = Progress()
+
+        def slow(items):
+            for item in items:
+                time.sleep(0.05)
+                yield item
+
+        list(progress.timed('parse', slow(progress.timed('fetch',
+                                                         slow([1, 2])))))
+        stages = progress.summary()['stages']
+
+        self.assertAlmostEqual(stages['fetch'], 0.1, delta=0.04)
+        self.assertAlmostEqual(stages['parse'], 0.1, delta=0.04)
+
+    def test_stages_of_other_threads_are_not_nested(self):
+        progress = Progress()
+
+        def slow(items):
+            for item in items:
+                time.sleep(0.05)
+                yield item
+
+        thread = Thread(target=list,
+                        args=(progress.timed('fetch', slow([1, 2])),))
+        thread.start()
+        progress.call('parse', time.sleep, 0.1)
+        thread.join()
+        stages = progress.summary()['stages']
+
+        self.assertAlmostEqual(stages['fetch'], 0.1, delta=0.04)
+        self.assertAlmostEqual(stages['parse'], 0.1, delta=0.04)
+
+    def test_events_are_dropped_when_queue_is_full(self):
+        progress = Progress(size=1)
+
+        progress.count('pages')
+        progress.emit('page', url='a')
+        progress.count('pages')
+        progress.emit('page', url='b')
+
+        self.assertEqual(progress.next_event(),
+                         {'event': 'page', 'url': 'a', 'pages': 1,
+                          'failures': 0, 'links': 0})
+        self.assertEqual(progress.summary()['pages'], 2)
+        self.assertEqual(progress.summary()['dropped_events'], 1)
+
+    def test_stream_sends_events_and_summary(self):
+        def job(urls, progress=None):
+            for url in urls:
+                progress.count('pages')
+                progress.emit('page', url=url)
+
+        server, client = socketpair()
+        progress = Progress()
+        stream(server, progress, job, [['a', 'b']], {'progress': progress})
+        server.close()
+        lines = client.makefile().read().splitlines()
+        client.close()
+
+        events = [json.loads(line) for line in lines]
+        self.assertEqual([event['event'] for event in events],
+                         ['accepted', 'page', 'page', 'summary'])
+        self.assertEqual(events[-1]['pages'], 2)
+
+
+class FakeHostInfo(object):
+    """
+    Mock for host_info.HostInfo with configurable load
+    """
+    cpu = 10.0
+    memory = 1 << 30
+
+    @classmethod
+    def cpu_usage(cls):
+        return cls.cpu
+
+    @classmethod
+    def ram_usage(cls):
+        return cls.memory
+
+    @staticmethod
+    def processes_count():
+        return 100
+
+
+class TestAdmission(unittest.TestCase):
+    """
+    Test admission of jobs by load of the host
+    """
+
+    def setUp(self):
+        self.host_info = type('HostInfo', (FakeHostInfo,), {})
+
+    def test_overload_shrinks_limit(self):
+        admission = Admission(max_jobs=4, host_info=self.host_info)
+
+        self.host_info.cpu = 95.0
+        self.assertTrue(admission.sample())
+        self.assertEqual(admission.limit, 2)
+        self.host_info.cpu = 10.0
+        self.host_info.memory = 1
+        admission.sample()
+        self.assertEqual(admission.limit, 1)
+        self.host_info.memory = 1 << 30
+        admission.sample()
+
+        stats = admission.stats()
+        self.assertEqual(stats['limit'], 2)
+        self.assertEqual(stats['shrunk'], 2)
+        self.assertEqual(stats['load']['processes'], 100)
+
+    def test_jobs_over_limit_are_queued_or_rejected(self):
+        admission = Admission(max_jobs=1, max_queue=1, max_wait=5,
+                              host_info=self.host_info)
+        self.assertTrue(admission.acquire())
+
+        result = []
+        waiter = Thread(target=lambda: result.append(admission.acquire()))
+        waiter.start()
+        while not admission.waiting:
+            time.sleep(0.01)
+
+        self.assertFalse(admission.acquire())
+        admission.release(2)
+        waiter.join()
+
+        self.assertEqual(result, [True])
+        self.assertEqual(admission.retry_after(), 2)
+        self.assertEqual(admission.stats()['rejected'], 1)
+
+    def test_waiting_too_long_is_rejected(self):
+        admission = Admission(max_jobs=1, max_wait=0.05,
+                              host_info=self.host_info)
+
+        self.assertTrue(admission.acquire())
+        self.assertFalse(admission.acquire())
+        self.assertEqual(admission.stats()['queued'], 1)
+
+
+class TestResponseCache(unittest.TestCase):
+    """
+    Test caching responses on disk
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.requests = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def request(self, status_code, response_headers):
+        def inner(url, headers=None):
+            self.requests.append(headers)
+            return CachedResponse(status_code, 'body of %s' % url,
+                                  response_headers)
+
+        return inner
+
+    def test_fresh_response_is_not_requested(self):
+        cache = ResponseCache(self.directory)
+        request = self.request(200, {'Cache-Control': 'max-age=60'})
+
+        cache.fetch('a', request)
+        response = cache.fetch('a', request)
+
+        self.assertEqual(response.content, 'body of a')
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_stale_response_is_revalidated(self):
+        cache = ResponseCache(self.directory)
+        cache.fetch('a', self.request(200, {'Cache-Control': 'no-cache',
+                                            'ETag': '"1"'}))
+
+        response = cache.fetch('a', self.request(304, {}))
+
+        self.assertEqual(response.content, 'body of a')
+        self.assertEqual(self.requests[-1], {'If-None-Match': '"1"'})
+        self.assertEqual(cache.stats()['revalidated'], 1)
+
+    def test_not_modified_without_body_is_requested_again(self):
+        cache = ResponseCache(self.directory)
+        cache.fetch('a', self.request(200, {'Cache-Control': 'no-cache',
+                                            'ETag': '"1"'}))
+        os.remove(cache._path(cache.key('a'), '.body'))
+
+        def request(url, headers=None):
+            self.requests.append(headers)
+            if headers:
+                return CachedResponse(304, '', {})
+            return CachedResponse(200, 'new body', {})
+
+        response = cache.fetch('a', request)
+
+        self.assertEqual(response.content, 'new body')
+        self.assertEqual(self.requests[-2:], [{'If-None-Match': '"1"'}, {}])
+
+    def test_last_use_survives_restart(self):
+        request = self.request(200, {})
+        cache = ResponseCache(self.directory, max_bytes=20)
+        cache.fetch('a', request)
+        cache.fetch('b', request)
+        cache.fetch('a', request)
+
+        cache = ResponseCache(self.directory, max_bytes=20)
+        cache.fetch('c', request)
+
+        self.assertEqual(sorted(meta['url'] for meta in
+                                cache.index.values()), ['a', 'c'])
+
+    def test_least_recently_used_is_evicted(self):
+        cache = ResponseCache(self.directory, max_bytes=20)
+        request = self.request(200, {})
+
+        cache.fetch('a', request)
+        cache.fetch('b', request)
+        cache.fetch('a', request)
+        cache.fetch('c', request)
+
+        self.assertEqual(sorted(meta['url'] for meta in
+                                ResponseCache(self.directory).index.values()),
+                         ['a', 'c'])
+
+
+class TestSeeds(unittest.TestCase):
+    """
+    Test streaming of seed urls by windows with checkpoints
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.checkpoint = self.directory + '/checkpoint'
+        self.fetched = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def fetch_urls(self, fail_on=None):
+        def fetch_urls(urls, **kwargs):
+            if fail_on in urls:
+                return None
+            self.fetched.append(sorted(urls))
+            return {}
+
+        return fetch_urls
+
+    def test_windows_skip_empty_lines_and_comments(self):
+        f = StringIO('a\n\n# comment\nb\nc\n')
+
+        self.assertEqual(list(windows(f, size=2)),
+                         [(2, ['a']), (4, ['b']), (5, ['c'])])
+        self.assertEqual(list(windows(StringIO('a\nb\nc\n'), 2, skip=2)),
+                         [(3, ['c'])])
+
+    def test_gzip_seeds_are_decompressed(self):
+        path = self.directory + '/seeds.gz'
+        with gzip.open(path, 'wb') as f:
+            f.write('http://vk.com\nhttp://bb.com\n')
+
+        f = open_seeds(path)
+        self.assertEqual(list(windows(f)),
+                         [(2, ['http://vk.com', 'http://bb.com'])])
+        f.close()
+
+    def test_windows_are_deduplicated(self):
+        seeds = StringIO('a\na\nb\nc\nc\n')
+        with patch('insert_db.fetch_urls', self.fetch_urls()):
+            stats = fetch_seeds(seeds, window=3)
+
+        self.assertEqual(self.fetched, [['a', 'b'], ['c']])
+        self.assertEqual((stats['lines'], stats['urls'],
+                          stats['duplicates']), (5, 3, 2))
+
+    def test_interrupted_run_is_resumed(self):
+        seeds = 'a\nb\nc\nd\ne\n'
+        with patch('insert_db.fetch_urls', self.fetch_urls(fail_on='c')):
+            stats = fetch_seeds(StringIO(seeds), window=2,
+                                checkpoint=Checkpoint(self.checkpoint, 's'))
+        self.assertTrue(stats['stopped'])
+        self.assertEqual(Checkpoint(self.checkpoint, 's').lines, 2)
+        self.assertEqual(Checkpoint(self.checkpoint, 'other').lines, 0)
+
+        with patch('insert_db.fetch_urls', self.fetch_urls()):
+            fetch_seeds(StringIO(seeds), window=2,
+                        checkpoint=Checkpoint(self.checkpoint, 's'))
+
+        self.assertEqual(self.fetched, [['a', 'b'], ['c', 'd'], ['e']])
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_windows_share_db_and_writer(self):
+        shared = []
+
+        def fetch_urls(urls, db=None, writer=None, **kwargs):
+            shared.append((db, writer))
+            return {}
+
+        with patch('insert_db.fetch_urls', fetch_urls):
+            stats = fetch_seeds(StringIO('a\nb\nc\n'), window=1)
+
+        self.assertEqual(len(shared), 3)
+        self.assertEqual(len(set(shared)), 1)
+        db, writer = shared[0]
+        self.assertIsNot(db, writer.db)
+        self.assertFalse(writer.thread.is_alive())
+        self.assertEqual(stats['writer']['batches'], 0)
+
+    def test_windows_share_parse_pool(self):
+        pools, used = [], []
+
+        def make_pool(workers=None):
+            pool = MagicMock()
+            pool.terminate = MagicMock()
+            pool.join = MagicMock()
+            pools.append(pool)
+            return pool
+
+        def fetch_urls(urls, parse_pool=None, **kwargs):
+            used.append(parse_pool)
+            return {}
+
+        with patch('insert_db.make_pool', make_pool), \
+                patch('insert_db.fetch_urls', fetch_urls):
+            fetch_seeds(StringIO('a\nb\nc\n'), window=1)
+
+        self.assertEqual(len(pools), 1)
+        self.assertEqual(used, pools * 3)
+        self.assertEqual(pools[0].terminate.call_count, 1)
+
+    def test_memo_is_saved_once_per_run(self):
+        memo = MagicMock()
+        memo.save = MagicMock()
+
+        with patch('insert_db.insert_urls', lambda db, urls: {'a': 1}), \
+                patch('insert_db.data_from_urls', lambda *args: iter([])):
+            fetch_seeds(StringIO('a\nb\nc\n'), window=1, memo=memo,
+                        parse_workers=1)
+
+        self.assertEqual(memo.save.call_count, 1)
+
+    def test_checkpoint_is_not_moved_past_lost_links(self):
+        class LostDB(DownDB):
+            def close(self):
+                pass
+
+        def make_writer(db, fingerprints=None, spool=None):
+            return DBWriter(LostDB()).start()
+
+        def fetch_urls(urls, writer=None, **kwargs):
+            writer.put(TestDBWriter.batch(1))
+            return {}
+
+        checkpoint = Checkpoint(self.checkpoint, 's')
+        with patch('insert_db.make_writer', make_writer), \
+                patch('insert_db.fetch_urls', fetch_urls):
+            stats = fetch_seeds(StringIO('a\nb\n'), window=1,
+                                checkpoint=checkpoint)
+
+        self.assertTrue(stats['stopped'])
+        self.assertEqual(Checkpoint(self.checkpoint, 's').lines, 0)
+
+    def test_main_rejects_checkpoint_of_stdin(self):
+        with patch('sys.argv', ['insert_db.py', '--seeds', '-',
+                                '--checkpoint', self.checkpoint]), \
+                patch('sys.stderr', StringIO()):
+            with self.assertRaises(SystemExit):
+                insert_db_main()
+
+
+class TestPageArchive(unittest.TestCase):
+    """
+    Test recording and replaying pages
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = self.directory + '/pages.gz'
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def record(self, *pages):
+        archive = PageArchive(self.path)
+        for url, content in pages:
+            archive.record(url, CachedResponse(200, content,
+                                               {'ETag': url}))
+        archive.close()
+
+    def test_page_is_read_by_url(self):
+        self.record(('a', 'body of a'), ('b', 'body of b'))
+
+        archive = PageArchive(self.path)
+        response = archive.get('b')
+
+        self.assertEqual(response, (200, 'body of b', {'ETag': 'b'}))
+        self.assertIsNone(archive.get('c'))
+        self.assertEqual(archive.urls(), ['a', 'b'])
+
+    def test_replay_skips_overwritten_pages(self):
+        self.record(('a', 'old'), ('b', 'body of b'), ('a', 'new'))
+
+        archive = PageArchive(self.path)
+
+        self.assertEqual(list(archive.pages()), [('b', 'body of b'),
+                                                 ('a', 'new')])
+        self.assertEqual(list(archive.pages(['a', 'c'])), [('a', 'new')])
+
+    def test_index_is_rebuilt_and_truncated_record_dropped(self):
+        self.record(('a', 'body of a'), ('b', 'body of b'))
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 5)
+        os.remove(self.path + '.idx')
+
+        archive = PageArchive(self.path)
+        archive.record('c', CachedResponse(200, 'body of c', {}))
+
+        self.assertEqual(archive.urls(), ['a', 'c'])
+        self.assertEqual(archive.get('c').content, 'body of c')
+
+    def test_replay_feeds_parser(self):
+        self.record(('a', '<a href="vk.com"></a>'),
+                    ('b', '<a href="bb.com"></a>'))
+
+        result = list(replay(PageArchive(self.path)))
+
+        self.assertEqual(result, [('a', 'vk.com'), ('b', 'bb.com')])
+
+
+class TestLinkMemo(unittest.TestCase):
+    """
+    Test memoization of extracted links
+    """
+
+    def setUp(self):
+        self.pages = [('a', '<a href="vk.com"></a>'),
+                      ('b', '<a href="vk.com"></a>'),
+                      ('c', '<a href="youtube.com"></a>')]
+
+    def test_same_body_is_parsed_once(self):
+        memo = LinkMemo()
+        list(extract_links(self.pages[:1], workers=1, memo=memo))
+
+        result = list(extract_links(self.pages, workers=1, memo=memo))
+
+        self.assertEqual(sorted(result), [('a', ['vk.com']), ('b', ['vk.com']),
+                                          ('c', ['youtube.com'])])
+        self.assertEqual(memo.stats()['hits'], 2)
+        self.assertEqual(memo.stats()['misses'], 2)
+
+    def test_memo_is_persisted(self):
+        directory = tempfile.mkdtemp()
+        path = directory + '/memo'
+        try:
+            memo = LinkMemo(path)
+            list(extract_links(self.pages, workers=1, memo=memo))
+            memo.save()
+
+            self.assertEqual(len(LinkMemo(path).entries), 2)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_least_recently_used_is_dropped(self):
+        memo = LinkMemo(max_entries=1)
+        list(extract_links(self.pages, workers=1, memo=memo))
+
+        self.assertEqual(memo.entries.values(), [['youtube.com']])
+
+
+class TestRecords(unittest.TestCase):
+    """
+    Test compact representation of parsed links
+    """
+
+    def test_ip_is_packed(self):
+        self.assertEqual(ip_to_int('1.1.1.1'), 16843009)
+        self.assertEqual(int_to_ip(16843009), '1.1.1.1')
+        self.assertEqual(ip_to_int(''), 0)
+
+    def test_batch_counts_links(self):
+        lst = [('a', HostingInfo('http://vk.com', '1.1.1.1', 'vk.com')),
+               ('a', HostingInfo('http://vk.com/1', '1.1.1.1', 'vk.com')),
+               ('b', HostingInfo('http://vk.com', '1.1.1.1', 'vk.com')),
+               ('b', HostingInfo('/', '0.0.0.0', ''))]
+
+        batch = batch_from(lst, {'a': 1, 'b': 2})
+
+        self.assertEqual(sorted(batch), [('', 0, 2, 1),
+                                         ('vk.com', 16843009, 1, 2),
+                                         ('vk.com', 16843009, 2, 1)])
+        self.assertEqual(batch.domains, ['vk.com', ''])
+
+    def test_domains_are_shared_between_links(self):
+        self.assertIs(domain_from_url('http://vk.com/intern/1'),
+                      domain_from_url(u'http://www.vk.com/intern/2'))
+
+    def test_equal_infos_have_equal_hashes(self):
+        first = HostingInfo('http://vk.com', '1.1.1.1', 'vk.com')
+        second = HostingInfo('http://vk.com', '1.1.1.1', 'vk.com')
+
+        self.assertEqual(len(set([first, second])), 1)
+
+    def test_batches_are_merged(self):
+        first, second = LinkBatch(), LinkBatch()
+        first.add('vk.com', 1, 1)
+        second.add('vk.com', 1, 1, 2)
+        second.add('youtube.com', 2, 1)
+
+        first.extend(second)
+
+        self.assertEqual(sorted(first), [('vk.com', 1, 1, 3),
+                                         ('youtube.com', 2, 1, 1)])
+
+
+class TestProfiler(unittest.TestCase):
+    """
+    Test profiling of jobs on demand
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.profiler = Profiler(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_jobs_are_not_profiled_by_default(self):
+        result = self.profiler.run(sum, [1, 2])
+
+        self.assertEqual(result, 3)
+        self.assertEqual(self.profiler.profiles(), [])
+
+    def test_armed_profiler_profiles_next_jobs(self):
+        self.profiler.arm(jobs=1)
+
+        self.profiler.run(sum, [1, 2])
+        self.profiler.run(sum, [1, 2])
+
+        profiles = self.profiler.profiles()
+        self.assertEqual([name.rsplit('.', 1)[1] for name in profiles],
+                         ['prof', 'txt'])
+        self.assertIn('cumulative', self.profiler.read(profiles[1]))
+
+    def test_unknown_mode_is_rejected(self):
+        with self.assertRaises(ValueError):
+            self.profiler.arm(mode='unknown')
+
+
+class TestFrontier(unittest.TestCase):
+    """
+    Test recursive crawling
+    """
+
+    def test_bloom_filter_remembers_keys(self):
+        seen = BloomFilter(capacity=100, error_rate=0.01)
+
+        self.assertTrue(seen.add('http://vk.com'))
+        self.assertFalse(seen.add('http://vk.com'))
+        self.assertIn('http://vk.com', seen)
+        self.assertNotIn('http://youtube.com', seen)
+
+    def test_spilled_urls_keep_order(self):
+        frontier = Frontier(memory_items=2, capacity=100)
+        for i in range(5):
+            frontier.push('url%s' % i, 'seed', 1)
+        frontier.push('url0', 'seed', 1)
+        frontier.push('seed', 'seed', 0)
+
+        result = [frontier.pop() for _ in range(len(frontier))]
+        stats = frontier.stats()
+        frontier.close()
+
+        self.assertEqual([url for url, _, _ in result],
+                         ['seed'] + ['url%s' % i for i in range(5)])
+        self.assertEqual(stats['spilled'], 4)
+        self.assertEqual(stats['duplicates'], 1)
+
+    @patch('parsing.socket.gethostbyname', new=fake_ip)
+    def test_crawl_stays_within_seed_domain(self):
+        pages = {
+            'http://vk.com/': '<a href="/a"></a><a href="http://bb.com"></a>',
+            'http://vk.com/a': '<a href="/"></a>',
+        }
+        fetched = []
+
+        def fetch_pages(urls, *args):
+            fetched.extend(urls)
+            return ((url, pages.get(url)) for url in urls)
+
+        frontier = Frontier(capacity=100)
+        with patch('frontier.fetch_pages', fetch_pages):
+            result = list(crawl(['http://vk.com/'], depth=2, workers=1,
+                                frontier=frontier))
+        frontier.close()
+
+        self.assertEqual(fetched, ['http://vk.com/', 'http://vk.com/a'])
+        self.assertEqual([info.link for _, info in result],
+                         ['http://vk.com/a', 'http://bb.com/',
+                          'http://vk.com/'])
+
+    @patch('parsing.socket.gethostbyname', new=fake_ip)
+    def test_crawl_creates_one_pool(self):
+        pools = []
+
+        class Pool(object):
+            def terminate(self):
+                pools.remove(self)
+
+            def join(self):
+                pass
+
+        def make_pool(workers):
+            pools.append(Pool())
+            return pools[-1]
+
+        def extract_links(pages, workers, memo, pool):
+            self.assertEqual(pools, [pool])
+            for url, content in pages:
+                yield url, ['/a%s' % len(url)]
+
+        def fetch_pages(urls, *args):
+            return ((url, 'page') for url in urls)
+
+        with patch('frontier.fetch_pages', fetch_pages), \
+                patch('frontier.make_pool', make_pool), \
+                patch('frontier.extract_links', extract_links), \
+                patch('frontier.BATCH_SIZE', 1):
+            result = list(crawl(['http://vk.com/'], depth=2, workers=2))
+
+        self.assertEqual(len(result), 3)
+        self.assertEqual(pools, [])
+
+
+class RowsCursor(object):
+    """
+    Cursor that returns given rows in chunks,
+    results replace rows when their query is executed
+    """
+
+    def __init__(self, rows, results=None):
+        self.rows = list(rows)
+        self.results = results or {}
+        self.queries = []
+
+    def __call__(self, cursor_class=None):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def execute(self, query, params=None):
+        self.queries.append((query, params))
+        if query in self.results:
+            self.rows = list(self.results[query])
+
+    def executemany(self, query, params):
+        self.queries.append((query, list(params)))
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def fetchall(self):
+        return self.fetchmany(len(self.rows))
+
+
+class TestExporter(unittest.TestCase):
+    """
+    Test streaming export of parsed links
+    """
+
+    def setUp(self):
+        self.rows = [(1, 'http://vk.com', '2017-01-01 00:00:00', 'vk.com',
+                      '1.1.1.1', 2),
+                     (1, 'http://vk.com', '2017-01-01 00:00:00', u'bb.com',
+                      '2.2.2.2', 1)]
+
+    def test_csv_export(self):
+        f = StringIO()
+        stats = export(self.rows, f, 'csv')
+
+        lines = f.getvalue().splitlines()
+        self.assertEqual(stats['rows'], 2)
+        self.assertEqual(lines[0],
+                         'url_id,url,creation_time,domain,ip,counter')
+        self.assertEqual(lines[2],
+                         '1,http://vk.com,2017-01-01 00:00:00,bb.com,'
+                         '2.2.2.2,1')
+
+    def test_ndjson_export(self):
+        f = StringIO()
+        export(self.rows, f, 'ndjson')
+
+        first = json.loads(f.getvalue().splitlines()[0])
+        self.assertEqual(first['domain'], 'vk.com')
+        self.assertEqual(first['counter'], 2)
+
+    def test_rows_are_filtered_and_fetched_in_chunks(self):
+        db = DBAPI('user', 'password', 'host', 'db')
+        db._connection = MagicMock()
+        db._connection.cursor = cursor = RowsCursor(self.rows)
+
+        result = list(db.iter_domain_ips(since='2017-01-01', url='a',
+                                         batch_size=1))
+
+        query, params = cursor.queries[0]
+        self.assertEqual(result, self.rows)
+        self.assertIn('WHERE urls.creation_time >= %s AND urls.url = %s',
+                      query)
+        self.assertEqual(params, ['2017-01-01', 'a'])
+
+
+class LoadCursor(RowsCursor):
+    """
+    Cursor that keeps content of loaded files
+    """
+
+    def __init__(self):
+        super(LoadCursor, self).__init__([])
+        self.loaded = []
+
+    def execute(self, query, params=None):
+        super(LoadCursor, self).execute(query, params)
+        if 'LOAD DATA' in query:
+            with open(params[0]) as f:
+                self.loaded.append(f.read())
+
+
+class DeltaDB(object):
+    """
+    Mock for db_api.DBAPI that records applied deltas
+    """
+
+    def __init__(self):
+        self.writes = []
+
+    def apply_deltas(self, links):
+        self.writes.append([(url_id, sorted(batch))
+                            for url_id, batch in links])
+        return {'upserted': sum(len(batch) for _, batch in links),
+                'deleted': 0}
+
+
+class TestDeltaWrites(unittest.TestCase):
+    """
+    Test writing only links that changed since the last crawl
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = self.directory + '/fingerprints'
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def crawl(self, fingerprints, db, data):
+        writer = DBWriter(db, write=fingerprints.writer(db)).start()
+        write_deltas(writer, fingerprints, data, {'a': 1, 'b': 2})
+        writer.close()
+
+    def test_unchanged_urls_are_not_written(self):
+        db = DeltaDB()
+        data = [('a', HostingInfo('x', '1.1.1.1', 'vk.com')),
+                ('a', HostingInfo('y', '1.1.1.1', 'vk.com')),
+                ('b', HostingInfo('z', '2.2.2.2', 'bb.com'))]
+
+        fingerprints = FingerprintStore(self.path)
+        self.crawl(fingerprints, db, data)
+        fingerprints.save()
+        fingerprints = FingerprintStore(self.path)
+        self.crawl(fingerprints, db, data[:1] + data[2:])
+
+        self.assertEqual(sum(db.writes, []),
+                         [(1, [('vk.com', 16843009, 1, 2)]),
+                          (2, [('bb.com', 33686018, 2, 1)]),
+                          (1, [('vk.com', 16843009, 1, 1)])])
+        self.assertEqual(fingerprints.url_ids(['a', 'c']), {'a': 1})
+        self.assertEqual(fingerprints.stats()['unchanged'], 1)
+
+    def test_only_changed_rows_are_written(self):
+        hour = '2017-01-01 10:00:00'
+        previous = [(1, 'vk.com', 1, 2), (1, 'bb.com', 2, 1)]
+        db = DBAPI('user', 'password', 'host', 'db')
+        db._connection = MagicMock()
+        db._connection.commit = MagicMock()
+        db._connection.cursor = first = RowsCursor(
+            [], {DBAPI.FETCH_URL_HOURS: [(1, hour)]})
+        db.insert([(domain, ip, url_id, counter)
+                   for url_id, domain, ip, counter in previous])
+        db._connection.cursor = cursor = RowsCursor(
+            previous, {DBAPI.FETCH_URL_HOURS: [(1, hour)]})
+        batch = LinkBatch()
+        batch.add('vk.com', 1, 1, 2)
+        batch.add('ya.ru', 3, 1)
+
+        result = db.apply_deltas([(1, batch)])
+
+        (_, upserts), (_, deletes), _, (_, domain_hours), _ = \
+            cursor.queries[1:]
+        self.assertEqual(result, {'upserted': 1, 'deleted': 1})
+        self.assertEqual(upserts, [('ya.ru', 3, 1, 1)])
+        self.assertEqual(deletes, [('bb.com', 2, 1)])
+        self.assertEqual(db._connection.commit.call_count, 2)
+
+        # the hour keeps the current links of the url, as after rebuild
+        totals = defaultdict(int)
+        for domain, bucket, counter in first.queries[2][1] + domain_hours:
+            totals[(domain, bucket)] += counter
+        self.assertEqual(dict(item for item in totals.items() if item[1]),
+                         {('vk.com', hour): 2, ('ya.ru', hour): 1})
+        self.assertTrue(all(counter >= 0 for counter in totals.values()))
+
+
+class FailingCursor(LoadCursor):
+    """
+    Cursor that fails on the query containing the given text
+    """
+
+    def __init__(self, text, error=InternalError):
+        super(FailingCursor, self).__init__()
+        self.text = text
+        self.error = error
+
+    def execute(self, query, params=None):
+        super(FailingCursor, self).execute(query, params)
+        if self.text in query:
+            raise self.error()
+
+    def executemany(self, query, params):
+        self.execute(query, params)
+
+
+class TestBulkInsert(unittest.TestCase):
+    """
+    Test loading big batches with LOAD DATA LOCAL INFILE
+    """
+
+    def setUp(self):
+        self.db = DBAPI('user', 'password', 'host', 'db', bulk_threshold=2)
+        self.db._connection = MagicMock()
+        self.db._connection.commit = MagicMock()
+        self.db._connection.cursor = self.cursor = LoadCursor()
+
+    def test_small_batch_uses_insert(self):
+        self.db.insert([('vk.com', '1.1.1.1', 1, 1)])
+
+        self.assertEqual(self.cursor.loaded, [])
+        self.assertEqual(self.cursor.queries[0][1],
+                         [('vk.com', '1.1.1.1', 1, 1)])
+        self.assertEqual(self.cursor.queries[-1][1], [(1, 1)])
+
+    def test_big_batch_is_loaded_and_merged(self):
+        batch = LinkBatch()
+        batch.add('vk.com', 16843009, 1)
+        batch.add('a\tb', 0, 2, 3)
+
+        self.db.insert(batch)
+
+        queries = [query for query, _ in self.cursor.queries]
+        self.assertEqual(sorted(self.cursor.loaded[0].splitlines()),
+                         ['a\\tb\t0\t2\t3', 'vk.com\t16843009\t1\t1'])
+        self.assertIn('INTO domain_ip ', queries[-3])
+        self.assertIn('INTO domain_hour', queries[-2])
+        self.assertIn('JOIN urls', queries[-2])
+        self.assertIn('INTO url_totals', queries[-1])
+        self.assertEqual(self.db._connection.commit.call_count, 1)
+
+    def test_failed_load_is_rolled_back(self):
+        self.db._connection.rollback = MagicMock()
+        self.db._connection.cursor = cursor = FailingCursor('LOAD DATA')
+
+        with self.assertRaises(InternalError):
+            self.db.insert([('vk.com', 1, 1, 1), ('bb.com', 2, 1, 1)])
+
+        self.assertEqual(self.db._connection.rollback.call_count, 1)
+        self.assertEqual(self.db._connection.commit.call_count, 0)
+        self.assertIn('DROP TEMPORARY TABLE', cursor.queries[-1][0])
+
+    def test_lost_connection_is_dropped(self):
+        connection = self.db._connection
+        connection.close = MagicMock()
+        connection.cursor = FailingCursor('LOAD DATA', OperationalError)
+
+        with self.assertRaises(OperationalError):
+            self.db.insert([('vk.com', 1, 1, 1), ('bb.com', 2, 1, 1)])
+
+        self.assertEqual(connection.close.call_count, 1)
+        self.assertFalse(hasattr(self.db, '_connection'))
+
+
+class SlowDB(object):
+    """
+    Mock for db_api.DBAPI that commits slowly
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.commits = []
+
+    def insert(self, data):
+        time.sleep(self.latency)
+        self.commits.append(sorted(data))
+
+
+class TestDBWriter(unittest.TestCase):
+    """
+    Test writing batches in background
+    """
+
+    @staticmethod
+    def batch(url_id):
+        batch = LinkBatch()
+        batch.add('vk.com', 1, url_id)
+        return batch
+
+    def test_batches_queued_during_commit_are_grouped(self):
+        db = SlowDB(0.05)
+        writer = DBWriter(db).start()
+
+        for url_id in range(1, 6):
+            writer.put(self.batch(url_id))
+        stats = writer.close()
+
+        self.assertEqual(sum(db.commits, []),
+                         [('vk.com', 1, url_id, 1) for url_id in range(1, 6)])
+        self.assertLess(len(db.commits), 5)
+        self.assertEqual(stats['commits'], len(db.commits))
+        self.assertEqual(stats['rows'], 5)
+        self.assertEqual(stats['depth'], 0)
+
+    def test_full_queue_blocks_producer(self):
+        writer = DBWriter(SlowDB(0.05), queue_size=1, group_rows=1).start()
+
+        for url_id in range(4):
+            writer.put(self.batch(url_id))
+        stats = writer.close()
+
+        self.assertEqual(stats['commits'], 4)
+        self.assertGreater(stats['blocked_seconds'], 0.05)
+        self.assertIsNotNone(stats['commit_p99'])
+
+    def test_callback_is_called_after_previous_batches(self):
+        db = SlowDB(0.05)
+        written = []
+        writer = DBWriter(db).start()
+
+        writer.put(self.batch(1))
+        writer.after(lambda: written.append(len(db.commits)))
+        writer.put(self.batch(2))
+        writer.close()
+
+        self.assertEqual(written, [1])
+        self.assertEqual(len(db.commits), 2)
+
+    def test_callback_is_skipped_after_lost_group(self):
+        called = []
+        writer = DBWriter(DownDB()).start()
+
+        writer.put(self.batch(1))
+        writer.after(lambda: called.append(1))
+        stats = writer.close()
+
+        self.assertEqual(called, [])
+        self.assertEqual((stats['failed'], stats['lost']), (1, 1))
+
+    def test_error_of_writer_is_raised_to_producer(self):
+        class BrokenSpool(object):
+            def append(self, batch):
+                raise IOError('disk is full')
+
+            def seal(self):
+                pass
+
+        writer = DBWriter(DownDB(), spool=BrokenSpool()).start()
+        writer.put(self.batch(1))
+        writer.thread.join(1)
+
+        self.assertFalse(writer.thread.is_alive())
+        with self.assertRaises(IOError):
+            writer.put(self.batch(2))
+        with self.assertRaises(IOError):
+            writer.close()
+
+
+class DownDB(object):
+    """
+    Mock for db_api.DBAPI that is unavailable
+    """
+
+    def insert(self, data):
+        raise DBAPIException('db is down')
+
+
+class SpoolDB(object):
+    """
+    Mock for db_api.DBAPI that remembers applied spooled batches
+    """
+
+    def __init__(self):
+        self.applied = {}
+
+    def insert_spooled(self, records):
+        new = [(batch_id, rows) for batch_id, rows in records
+               if batch_id not in self.applied]
+        self.applied.update(new)
+        return len(new)
+
+
+class TestSpool(unittest.TestCase):
+    """
+    Test spooling links while db is unavailable and replaying them
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_failed_batches_are_spooled(self):
+        spool = Spool(self.directory)
+        writer = DBWriter(DownDB(), spool=spool).start()
+
+        writer.put(TestDBWriter.batch(1))
+        writer.put(TestDBWriter.batch(2))
+        stats = writer.close()
+
+        records = [record for path in sealed_segments(self.directory)
+                   for record in read_segment(path)]
+        self.assertEqual(sorted(row for record in records
+                                for row in record['rows']),
+                         [['vk.com', 1, 1, 1], ['vk.com', 1, 2, 1]])
+        self.assertEqual(stats['failed'], 1)
+        self.assertGreaterEqual(stats['spooled'], 1)
+
+    def test_corrupted_records_are_skipped(self):
+        spool = Spool(self.directory)
+        spool.append([('vk.com', 1, 1, 1)])
+        spool.append([('bb.com', 2, 2, 1)])
+        path = spool.segment + '.open'
+        with open(path) as f:
+            lines = f.readlines()
+        with open(path, 'w') as f:
+            f.write(lines[0].replace('vk.com', 'vk.org') + lines[1])
+        spool.seal()
+
+        records = list(read_segment(sealed_segments(self.directory)[0]))
+
+        self.assertEqual([record['rows'] for record in records],
+                         [[['bb.com', 2, 2, 1]]])
+
+    def test_replay_is_idempotent(self):
+        spool = Spool(self.directory, segment_bytes=1)
+        spool.append([('vk.com', 1, 1, 1)])
+        spool.append([('bb.com', 2, 2, 1)])
+        segment = sealed_segments(self.directory)[0]
+        shutil.copy(segment, self.directory + '/copy')
+        db = SpoolDB()
+
+        first = replay_spool(self.directory, db)
+        shutil.copy(self.directory + '/copy', segment)
+        second = replay_spool(self.directory, db)
+
+        self.assertEqual((first['segments'], first['batches']), (2, 2))
+        self.assertEqual((second['batches'], second['skipped']), (0, 1))
+        self.assertEqual(len(db.applied), 2)
+        self.assertEqual(sealed_segments(self.directory), [])
+
+    def test_applied_batches_are_not_loaded(self):
+        db = DBAPI('user', 'password', 'host', 'db')
+        db._connection = MagicMock()
+        db._connection.commit = MagicMock()
+        db._connection.cursor = cursor = LoadCursor()
+        cursor.rows = [('a',)]
+
+        applied = db.insert_spooled([('a', [['vk.com', 1, 1, 1]]),
+                                     ('b', [[u'bb.com', 2, 2, 1]])])
+
+        self.assertEqual(applied, 1)
+        self.assertEqual(cursor.loaded, ['bb.com\t2\t2\t1\n'])
+        self.assertEqual(cursor.queries[-1][1], [('b',)])
+        self.assertEqual(db._connection.commit.call_count, 1)
+
+
+class TestRollups(unittest.TestCase):
+    """
+    Test rollups updated together with inserted links
+    """
+
+    def test_rollups_are_updated_in_same_transaction(self):
+        db = DBAPI('user', 'password', 'host', 'db')
+        db._connection = MagicMock()
+        db._connection.commit = MagicMock()
+        db._connection.cursor = cursor = RowsCursor([], {
+            DBAPI.FETCH_URL_HOURS: [(1, '2017-01-01 10:00:00'),
+                                    (2, '2017-01-01 11:00:00')]})
+
+        db.insert([('vk.com', '1.1.1.1', 1, 2), ('vk.com', '2.2.2.2', 1, 1),
+                   ('bb.com', '1.1.1.1', 2, 1), ('ya.ru', '1.1.1.1', 3, 1)])
+
+        (_, hours), (_, domain_hours), (_, url_totals) = cursor.queries[1:]
+        self.assertEqual(sorted(hours[1]), [1, 2, 3])
+        self.assertEqual(sorted(domain_hours),
+                         [('bb.com', '2017-01-01 11:00:00', 1),
+                          ('vk.com', '2017-01-01 10:00:00', 3)])
+        self.assertEqual(sorted(url_totals), [(1, 3), (2, 1), (3, 1)])
+        self.assertEqual(db._connection.commit.call_count, 1)
+
+    def test_links_are_rolled_back_when_rollups_fail(self):
+        db = DBAPI('user', 'password', 'host', 'db')
+        db._connection = MagicMock()
+        db._connection.commit = MagicMock()
+        db._connection.rollback = MagicMock()
+        db._connection.cursor = FailingCursor('domain_hour')
+
+        with self.assertRaises(InternalError):
+            db.insert([('vk.com', '1.1.1.1', 1, 2)])
+
+        self.assertEqual(db._connection.commit.call_count, 0)
+        self.assertEqual(db._connection.rollback.call_count, 1)
+
+
 class Cursor(object):
 
     def __enter__(self):
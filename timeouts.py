@@ -0,0 +1,216 @@
+"""
+Module for adaptive per-host request timeouts
+
+Latencies of the last requests are kept for every host, timeout of the
+host is a multiple of its latency percentile within fixed bounds.
+Requests that time out are kept in the same window apart from latencies.
+One timeout per window is the tail the percentile allows for, every
+further one multiplies the timeout by the factor while the slowest
+answer of the window is within the factor of the timeout. So timeout of
+slow but healthy host grows until its pages are retrieved, while host
+that does not answer keeps its timeout and single stall of fast host
+does not change it
+
+Optionally the request is hedged: when the first request is not answered
+after p95 latency of the host, the second one is sent by the small pool
+of threads shared by requests and the first answer is used
+"""
+
+import logging
+import threading
+import time
+
+from collections import Counter, deque
+from multiprocessing.pool import ThreadPool
+from Queue import Empty, Queue
+from urlparse import urlparse
+
+import requests
+
+from utils import percentile
+
+DEFAULT_TIMEOUT = 3
+MIN_TIMEOUT = 0.5
+MAX_TIMEOUT = 15
+TIMEOUT_PERCENTILE = 99
+TIMEOUT_FACTOR = 2
+HEDGE_PERCENTILE = 95
+WINDOW = 100
+MIN_SAMPLES = 10
+HEDGE_THREADS = 16
+
+
+class HostTimeouts(object):
+    """
+    Tracks latency of hosts and requests pages with adaptive timeouts
+    """
+
+    def __init__(self, default=DEFAULT_TIMEOUT, min_timeout=MIN_TIMEOUT,
+                 max_timeout=MAX_TIMEOUT, pct=TIMEOUT_PERCENTILE,
+                 factor=TIMEOUT_FACTOR, window=WINDOW,
+                 min_samples=MIN_SAMPLES, hedge=False,
+                 hedge_pct=HEDGE_PERCENTILE, hedge_threads=HEDGE_THREADS):
+        """
+        :Parameters:
+            - `default`: float timeout of host with few samples
+            - `min_timeout`: float lower bound of the timeout
+            - `max_timeout`: float upper bound of the timeout
+            - `pct`: float latency percentile the timeout is based on
+            - `factor`: float multiplier of the latency percentile
+            - `window`: int number of last latencies kept per host
+            - `min_samples`: int number of latencies needed to adapt
+            - `hedge`: bool send second request to slow hosts
+            - `hedge_pct`: float latency percentile after which the
+              second request is sent
+            - `hedge_threads`: int number of threads sending hedged
+              requests, started with the first hedged request
+        """
+        self.default = default
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.pct = pct
+        self.factor = factor
+        self.window = window
+        self.min_samples = min_samples
+        self.hedge = hedge
+        self.hedge_pct = hedge_pct
+        self.hedge_threads = hedge_threads
+        self.executor = None
+        self.latencies = {}
+        self.lock = threading.Lock()
+        self.counters = Counter()
+
+    def record(self, host, latency):
+        """
+        :Parameters:
+            - `host`: str
+            - `latency`: float seconds, None if request timed out
+        """
+        with self.lock:
+            samples = self.latencies.get(host)
+            if samples is None:
+                samples = self.latencies[host] = deque(maxlen=self.window)
+            samples.append(latency)
+
+    def _samples(self, host):
+        """
+        :Return:
+            tuple(list of latencies, int number of timeouts)
+        """
+        with self.lock:
+            samples = list(self.latencies.get(host, ()))
+        latencies = [latency for latency in samples if latency is not None]
+        return latencies, len(samples) - len(latencies)
+
+    def _percentile(self, host, pct):
+        latencies, _ = self._samples(host)
+        if len(latencies) < self.min_samples:
+            return None
+        return percentile(latencies, pct)
+
+    def timeout(self, host):
+        """
+        :Parameters:
+            - `host`: str
+        :Return:
+            float seconds
+        """
+        latencies, stalls = self._samples(host)
+        if len(latencies) < self.min_samples:
+            timeout = self.default
+        else:
+            timeout = max(self.min_timeout,
+                          percentile(latencies, self.pct) * self.factor)
+        slowest = max(latencies) if latencies else 0
+        for _ in range(stalls - 1):
+            if slowest * self.factor < timeout:
+                break
+            timeout *= self.factor
+        return min(self.max_timeout, timeout)
+
+    def hedge_delay(self, host):
+        """
+        :Parameters:
+            - `host`: str
+        :Return:
+            float seconds after which the second request is sent
+            or None if request should not be hedged
+        """
+        if not self.hedge:
+            return None
+        return self._percentile(host, self.hedge_pct)
+
+    def _request(self, host, url, headers, timeout, session):
+        start = time.time()
+        try:
+            response = (session or requests).get(url, timeout=timeout,
+                                                 verify=False, headers=headers)
+        except requests.exceptions.Timeout:
+            self.record(host, None)
+            with self.lock:
+                self.counters['timeouts'] += 1
+            raise
+        self.record(host, time.time() - start)
+        return response
+
+    def _start(self, results, number, host, url, headers, timeout, session):
+        def target():
+            try:
+                results.put((number, True, self._request(
+                    host, url, headers, timeout, session)))
+            except Exception as err:
+                results.put((number, False, err))
+
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPool(self.hedge_threads)
+        self.executor.apply_async(target)
+
+    def get(self, url, headers=None, session=None):
+        """
+        Requests the page with timeout of its host
+        :Parameters:
+            - `url`: str
+            - `headers`: dict of additional request headers
+            - `session`: requests.Session to keep connections alive
+        :Return:
+            requests.Response
+        """
+        host = urlparse(url).hostname or ''
+        timeout = self.timeout(host)
+        delay = self.hedge_delay(host)
+        with self.lock:
+            self.counters['requests'] += 1
+        if delay is None or delay >= timeout:
+            return self._request(host, url, headers, timeout, session)
+
+        results = Queue()
+        self._start(results, 0, host, url, headers, timeout, session)
+        try:
+            number, ok, value = results.get(timeout=delay)
+        except Empty:
+            logging.info('Hedging request to %s after %.3fs', url, delay)
+            with self.lock:
+                self.counters['hedged'] += 1
+            self._start(results, 1, host, url, headers, timeout, session)
+            number, ok, value = results.get()
+            if not ok:
+                number, ok, value = results.get()
+            if ok and number:
+                with self.lock:
+                    self.counters['hedge_wins'] += 1
+
+        if not ok:
+            raise value
+        return value
+
+    def stats(self):
+        """
+        :Return:
+            dict of counters and current timeouts of hosts
+        """
+        with self.lock:
+            stats = dict(self.counters)
+            hosts = list(self.latencies)
+        stats['hosts'] = dict((host, self.timeout(host)) for host in hosts)
+        return stats
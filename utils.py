@@ -2,6 +2,7 @@
 Basic unitility functions for everyday usage
 """
 
+from functools import wraps
 from itertools import islice
 
 
@@ -18,3 +19,49 @@ def split_every(n, iterable):
     while piece:
         yield piece
         piece = list(islice(i, n))
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of the values
+    :Parameters:
+         - `values`: list of numbers
+         - `pct`: float percentile in range [0, 100]
+    :Return:
+        number or None if values are empty
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[min(max(index, 0), len(ordered) - 1)]
+
+
+def memoize(maxsize):
+    """
+    Decorator that memoizes function of one argument
+    Cache is cleared when it grows over maxsize
+    :Parameters:
+         - `maxsize`: int
+    :Return:
+        wrapped function
+    """
+
+    def wrapper(func):
+        cache = {}
+
+        @wraps(func)
+        def inner(arg):
+            try:
+                return cache[arg]
+            except KeyError:
+                pass
+            if len(cache) >= maxsize:
+                cache.clear()
+            result = cache[arg] = func(arg)
+            return result
+
+        inner.cache = cache
+        return inner
+
+    return wrapper
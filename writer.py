@@ -0,0 +1,227 @@
+"""
+Module for writing links into db in background
+
+Batches are put into the bounded queue and written by the dedicated
+thread that owns the db connection, so crawling does not wait for
+commits. When the queue is full the crawl waits for the writer.
+Batches queued while the previous commit was running are merged and
+written with one commit
+
+With spool.Spool the crawl never waits: batches that do not fit into
+the queue and groups that failed to commit are spooled to disk, and
+after a failure db is not tried for RETRY_AFTER seconds
+
+Any other error stops the writer and is raised by the next put or close
+Callbacks queued with after are called by the writer once batches
+queued before them are written, so the producer does not wait for them.
+After a group failed and was not spooled callbacks are not called
+anymore, e.g. checkpoint is not moved past the lost links
+"""
+
+import logging
+import threading
+import time
+
+from collections import deque
+from Queue import Empty, Full, Queue
+
+from db_api import BULK_THRESHOLD
+from utils import percentile
+
+QUEUE_SIZE = 100
+GROUP_ROWS = BULK_THRESHOLD
+WINDOW = 1000
+RETRY_AFTER = 5
+POLL_INTERVAL = 0.5
+
+STOP = object()
+
+
+class Callback(object):
+    """
+    Function queued between batches
+    """
+
+    __slots__ = ('func',)
+
+    def __init__(self, func):
+        self.func = func
+
+
+class DBWriter(object):
+    """
+    Background writer of records.LinkBatch or other batches
+    """
+
+    def __init__(self, db, queue_size=QUEUE_SIZE, group_rows=GROUP_ROWS,
+                 write=None, spool=None, retry_after=RETRY_AFTER):
+        """
+        :Parameters:
+            - `db`: db_api.DBAPI used only by the writer from now on
+            - `queue_size`: int maximal number of pending batches
+            - `group_rows`: int maximal number of rows in one commit
+            - `write`: callable that writes the group with one commit,
+              db.insert by default. Batches must support len and extend
+            - `spool`: spool.Spool for batches that were not written,
+              only for batches of rows
+            - `retry_after`: float seconds db is not tried after failure
+        """
+        self.db = db
+        self.write = write or db.insert
+        self.spool = spool
+        self.retry_after = retry_after
+        self.down_until = 0
+        self.queue = Queue(queue_size)
+        self.group_rows = group_rows
+        self.latencies = deque(maxlen=WINDOW)
+        self.counters = dict.fromkeys(
+            ('batches', 'commits', 'rows', 'failed', 'spooled', 'lost',
+             'max_depth'), 0)
+        self.blocked = 0.0
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def put(self, batch):
+        """
+        Queues the batch, waits while the queue is full
+        unless there is the spool
+        :Parameters:
+            - `batch`: records.LinkBatch, owned by the writer from now on
+        Raises the error that stopped the writer
+        """
+        self._check()
+        self.counters['batches'] += 1
+        if self.spool:
+            try:
+                self.queue.put_nowait(batch)
+            except Full:
+                self._spool(batch)
+                return
+        else:
+            start = time.time()
+            self._put(batch)
+            self.blocked += time.time() - start
+        self.counters['max_depth'] = max(self.counters['max_depth'],
+                                         self.queue.qsize())
+
+    def after(self, func):
+        """
+        Calls func in the writer thread after batches queued before it
+        are committed or spooled, it is not called if any group was lost
+        :Parameters:
+            - `func`: callable without arguments
+        """
+        self._check()
+        self._put(Callback(func))
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def _put(self, item):
+        """
+        Waits for the place in the queue while the writer is running
+        """
+        while True:
+            try:
+                self.queue.put(item, timeout=POLL_INTERVAL)
+                return
+            except Full:
+                self._check()
+
+    def _run(self):
+        try:
+            self._write_groups()
+        except Exception as err:
+            logging.exception('Writer stopped')
+            self.error = err
+
+    def _write_groups(self):
+        stopped = False
+        while not stopped:
+            group = self.queue.get()
+            if group is STOP:
+                break
+            if isinstance(group, Callback):
+                self._call(group)
+                continue
+            callback = None
+            while len(group) < self.group_rows:
+                try:
+                    batch = self.queue.get_nowait()
+                except Empty:
+                    break
+                if batch is STOP:
+                    stopped = True
+                    break
+                if isinstance(batch, Callback):
+                    callback = batch
+                    break
+                group.extend(batch)
+            self._commit(group)
+            if callback:
+                self._call(callback)
+
+    def _call(self, callback):
+        if self.counters['lost']:
+            logging.error('Skipped callback, %s groups were lost',
+                          self.counters['lost'])
+            return
+        callback.func()
+
+    def _spool(self, batch):
+        self.spool.append(batch)
+        self.counters['spooled'] += 1
+
+    def _commit(self, group):
+        if self.spool and time.time() < self.down_until:
+            self._spool(group)
+            return
+
+        start = time.time()
+        try:
+            self.write(group)
+        except Exception:
+            logging.exception('Failed to write %s rows', len(group))
+            self.counters['failed'] += 1
+            if self.spool:
+                self.down_until = time.time() + self.retry_after
+                self._spool(group)
+            else:
+                self.counters['lost'] += 1
+            return
+        self.latencies.append(time.time() - start)
+        self.counters['commits'] += 1
+        self.counters['rows'] += len(group)
+
+    def close(self):
+        """
+        Writes pending batches and stops the writer
+        Raises the error that stopped the writer
+        :Return:
+            dict stats
+        """
+        try:
+            self._put(STOP)
+            self.thread.join()
+        finally:
+            if self.spool:
+                self.spool.seal()
+        self._check()
+        return self.stats()
+
+    def stats(self):
+        """
+        :Return:
+            dict with queue depth, commits and commit latency
+        """
+        latencies = list(self.latencies)
+        return dict(self.counters, depth=self.queue.qsize(),
+                    blocked_seconds=self.blocked,
+                    commit_p50=percentile(latencies, 50),
+                    commit_p99=percentile(latencies, 99))